@@ -0,0 +1,325 @@
+#!/usr/bin/python
+'''
+Synthetic datasets and a repeatable benchmark of the hot code paths.
+
+  LunchBench.py generate dbfile [--restaurants N] [--users N] [--years N] [--turnout F] [--seed N]
+  LunchBench.py run dbfile [--repeat N] [--output results.json]  (generates dbfile first if it's missing)
+  LunchBench.py compare old.json new.json [--threshold 1.25]
+
+run prints its results as JSON (or writes them to --output), with the
+commit they were measured at, so results can be kept and compared between
+commits. compare exits 1 if any benchmark's median got slower by more than
+the threshold.
+'''
+from LunchDB import *
+from LunchDB import Session
+from LunchRank import calculateRank, rebuildRatings
+from LunchVote import SchulzeTally, encodeResults
+
+import argparse
+import json
+import os, os.path
+import platform
+import random
+import subprocess
+import sys
+from datetime import datetime, date, timedelta
+from timeit import default_timer
+
+from sqlalchemy import event, bindparam
+
+__all__ = ['generate', 'benchmark', 'compare']
+
+CUISINES = ["Pizza", "Sandwiches", "Chinese", "Mexican", "Chicken", "Italian", "Vietnamese", "Japanese",
+            "Thai", "Indian", "Burgers", "Sushi", "Greek", "Korean", "BBQ", "Salad", "Ramen", "Tacos"]
+
+BATCH = 10000       #Rows per executemany
+
+def insert(db, model, rows):
+    #Bulk inserts rows (dicts) into a model's table
+    for i in range(0, len(rows), BATCH):
+        db.execute(model.__table__.insert(), rows[i:i+BATCH])
+
+def generate(dbfile, restaurants=1000, users=5000, years=10, turnout=0.05, ballot_size=5, seed=1, open_event=True):
+    '''
+    Creates a new dbfile holding a plausible history: `restaurants` places
+    of varying quality (a few disabled), `users` people who each vote in
+    about `turnout` of the events, a weekly event for `years` years with a
+    ballot of `ballot_size` choices, their votes, Schulze winners, stored
+    results and rating histograms, and (with open_event) one event open
+    for voting now.
+    The same arguments give the same dataset (relative to today's date).
+    Returns the row counts.
+    '''
+    if os.path.exists(dbfile):
+        raise ValueError("%s already exists"%dbfile)
+    rng = random.Random(seed)
+    LunchDB(dbfile)
+    db = Session()
+
+    today = date.today()
+    weeks = int(years*52)
+    start = today - timedelta(weeks=weeks)
+
+    #Restaurants: a hidden quality decides how people rate them
+    quality = {}
+    rows = []
+    for i in range(1, restaurants+1):
+        name = "%s %d"%(CUISINES[i%len(CUISINES)], i)
+        quality[i] = rng.betavariate(2, 2)
+        rows.append({"id":i, "name":name, "rank":0.0, "visits":0, "last":date(1900, 1, 1), "added":start,
+                     "enabled":rng.random() > 0.05,
+                     "website":"http://example.com/%d"%i if rng.random() < 0.5 else None})
+    insert(db, Restaurant, rows)
+    names = dict((R["id"], R["name"]) for R in rows)
+    enabled = [R["id"] for R in rows if R["enabled"]]
+    visits = dict((R, [0, date(1900, 1, 1)]) for R in enabled)
+
+    #Users: how often each one votes (a few vote nearly every week, most rarely)
+    activity = {}
+    for i in range(1, users+1):
+        activity[i] = min(1.0, rng.expovariate(1.0/turnout)) if turnout > 0 else 0.0
+    insert(db, User, [{"id":i, "name":"User %d"%i, "email":"user%d@example.com"%i, "tb_count":0}
+                      for i in range(1, users+1)])
+
+    counts = {"restaurants":restaurants, "users":users, "events":weeks+1 if open_event else weeks, "votes":0}
+    voteid = 0
+    for week in range(counts["events"]):
+        eventid = week+1
+        when = start + timedelta(weeks=week)
+        opens = datetime.combine(when, datetime.min.time()) + timedelta(hours=9, minutes=30)
+        is_open = week == weeks
+        if is_open:
+            opens = datetime.now()
+        choices = rng.sample(enabled, min(ballot_size, len(enabled)))
+
+        ballots = {}
+        votes = []
+        for user in range(1, users+1):
+            if rng.random() >= activity[user]:
+                continue
+            ballot = {}
+            for rest in choices:
+                rank = int(round(1 + 4*quality[rest] + rng.gauss(0, 1)))
+                rank = max(1, min(5, rank))
+                ballot[names[rest]] = rank
+                voteid += 1
+                votes.append({"id":voteid, "event":eventid, "restaurant":rest, "user":user, "rank":rank})
+            ballots[user] = ballot
+
+        winner = None
+        results = None
+        if not is_open and ballots:
+            tie_breaker = [names[R] for R in choices]
+            rng.shuffle(tie_breaker)
+            results = SchulzeTally(ballots).results(tie_breaker=tie_breaker)
+            winner = dict((names[R], R) for R in choices)[results["winner"]]
+            visits[winner][0] += 1
+            visits[winner][1] = when
+
+        db.execute(Event.__table__.insert(), {"id":eventid, "date":when, "winner_id":winner})
+        insert(db, Choice, [{"event":eventid, "num":n, "restaurant":R} for n, R in enumerate(choices)])
+        insert(db, Vote, votes)
+        db.execute(EventWindow.__table__.insert(), {"event":eventid, "opens":opens,
+            "closes":datetime.now() + timedelta(hours=2) if is_open else opens + timedelta(hours=1, minutes=30),
+            "closed":not is_open, "ballots":len(ballots) if is_open else 0})
+        if not is_open:
+            db.execute(EventResult.__table__.insert(), {"event":eventid, "data":encodeResults(results),
+                                                        "winner":results["winner"] if results else None})
+        counts["votes"] += len(votes)
+
+    db.execute(Restaurant.__table__.update().where(Restaurant.__table__.c.id==bindparam("rest_id")).values(
+        visits=bindparam("new_visits"), last=bindparam("new_last")),
+        [{"rest_id":R, "new_visits":V[0], "new_last":V[1]} for R, V in visits.items()])
+    db.commit()
+
+    rebuildRatings(db)
+    calculateRank(db, update=True)
+    db.close()
+    return counts
+
+#
+# Benchmarks
+#
+
+class QueryCounter(object):
+    #Counts the statements an engine runs
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self.executed)
+
+    def executed(self, *args):
+        self.count += 1
+
+def timed(function, repeat, counter):
+    '''Runs function once to warm up, then `repeat` times; returns its timings and queries per run'''
+    function()
+    times = []
+    before = counter.count
+    for i in range(repeat):
+        started = default_timer()
+        function()
+        times.append(default_timer() - started)
+    times.sort()
+    middle = len(times)//2
+    return {"runs":repeat, "min":times[0], "max":times[-1], "mean":sum(times)/len(times),
+            "median":times[middle] if len(times)%2 else (times[middle-1] + times[middle])/2,
+            "queries":(counter.count - before)//repeat}
+
+def commit():
+    #The commit the benchmark was run at, if this is a git checkout
+    try:
+        with open(os.devnull, "w") as null:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=null,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark(dbfile, repeat=5):
+    '''
+    Times the ranking, vote counting and ballot picking functions and the
+    index, results and vote pages against dbfile. The pages are rendered by
+    calling their handlers with the same plugins lunch.py runs, without the
+    HTTP server. Returns the results as a dict.
+    '''
+    import cherrypy
+    from cherrypy import _cprequest
+    import lunch
+    from saplugin import SAEnginePlugin
+
+    lunchdb = LunchDB(dbfile)
+    counter = QueryCounter(lunchdb.engine)
+    cherrypy.config.update({'engine.autoreload.on': False, 'log.screen': False})
+    cherrypy.server.unsubscribe()
+    SAEnginePlugin(cherrypy.engine, engine=lunchdb.engine).subscribe()
+    lunch.OpenEvent(cherrypy.engine).subscribe()
+    lunch.Leaderboard(cherrypy.engine).subscribe()
+    lunch.ResultsVersion(cherrypy.engine).subscribe()
+    cherrypy.engine.start()
+
+    try:
+        #The functions are timed in a session of their own; the pages bind theirs like a request does
+        db = Session()
+        root = lunch.Lunch()
+        manager = lunch.Manager(cherrypy.engine)
+        dataset = {"restaurants":db.query(Restaurant).count(), "users":db.query(User).count(),
+                   "events":db.query(Event).count(), "votes":db.query(Vote).count()}
+        latest = db.query(Event).filter(Event.winner_id!=None).order_by(Event.id.desc()).first()
+        oldest = db.query(Event.id).order_by(Event.date, Event.id).offset(10).limit(1).scalar()
+        user = db.query(User).order_by(User.id).first()
+        snapshot = cherrypy.engine.publish("get-snapshot")[0]
+        cherrypy.engine.publish("commit-session")
+
+        def render(handler, *args, **kwargs):
+            #Calls a page handler the way CherryPy would, and reads the whole page
+            cherrypy.serving.response = _cprequest.Response()
+            cherrypy.serving.request.db = cherrypy.engine.publish("bind-session")[0]
+            try:
+                body = handler(*args, **kwargs)
+                if not isinstance(body, basestring):
+                    body = "".join(body)
+            finally:
+                cherrypy.engine.publish("commit-session")
+            return body
+
+        def index():
+            cherrypy.engine.publish("invalidate-leaderboard")
+            render(root.index)
+
+        def seeded(function, *args):
+            #Same random choices on every run
+            def run():
+                random.seed(1)
+                function(*args)
+            return run
+
+        cases = [
+            ("calculateRank", seeded(calculateRank, db)),
+            ("calculateRank_user", seeded(calculateRank, db, user)),
+            ("calculateVote", seeded(lunch.calculateVote, db, latest)),
+            ("getChoices", seeded(manager.getChoices, db)),
+            ("index", index),
+            ("index_cached", lambda: render(root.index)),
+            ("results", lambda: render(root.results)),
+            ("results_history", lambda: render(root.results, before=str(oldest))),
+        ]
+        if snapshot is not None:
+            cases.append(("vote", lambda: render(root.vote, u=user.email)))
+
+        results = {}
+        for name, function in cases:
+            results[name] = timed(function, repeat, counter)
+            sys.stderr.write("%-20s median %8.2fms  %4d queries\n"%(name, results[name]["median"]*1000, results[name]["queries"]))
+    finally:
+        cherrypy.engine.exit()
+
+    return {"commit":commit(), "date":datetime.now().isoformat(), "python":platform.python_version(),
+            "dbfile":dbfile, "dataset":dataset, "repeat":repeat, "benchmarks":results}
+
+def compare(old, new, threshold=1.25):
+    '''Prints how each benchmark's median changed; returns the names of those slower by more than threshold'''
+    slower = []
+    print "%-20s %10s %10s %7s"%("benchmark", "old ms", "new ms", "ratio")
+    for name in sorted(set(old["benchmarks"]) & set(new["benchmarks"])):
+        before = old["benchmarks"][name]["median"]
+        after = new["benchmarks"][name]["median"]
+        ratio = after/before if before else float("inf")
+        flag = ""
+        if ratio > threshold:
+            slower.append(name)
+            flag = "  SLOWER"
+        print "%-20s %10.2f %10.2f %6.2fx%s"%(name, before*1000, after*1000, ratio, flag)
+    return slower
+
+#
+# Run this directly to make a dataset, benchmark it, or compare two runs
+#
+
+def main():
+    parser = argparse.ArgumentParser(description="Lunch benchmarks")
+    commands = parser.add_subparsers(dest="command")
+
+    gen = commands.add_parser("generate", help="create a synthetic dbfile")
+    run = commands.add_parser("run", help="benchmark a dbfile, generating it first if it doesn't exist")
+    for P in (gen, run):
+        P.add_argument("dbfile")
+        P.add_argument("--restaurants", type=int, default=1000)
+        P.add_argument("--users", type=int, default=5000)
+        P.add_argument("--years", type=float, default=10)
+        P.add_argument("--turnout", type=float, default=0.05, help="fraction of users voting in an event")
+        P.add_argument("--seed", type=int, default=1)
+    run.add_argument("--repeat", type=int, default=5)
+    run.add_argument("--output", help="write the JSON results here rather than to stdout")
+
+    cmp = commands.add_parser("compare", help="compare two run outputs")
+    cmp.add_argument("old")
+    cmp.add_argument("new")
+    cmp.add_argument("--threshold", type=float, default=1.25, help="ratio of medians that counts as slower")
+
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.old) as F:
+            old = json.load(F)
+        with open(args.new) as F:
+            new = json.load(F)
+        sys.exit(1 if compare(old, new, args.threshold) else 0)
+
+    if args.command == "generate" or not os.path.exists(args.dbfile):
+        started = default_timer()
+        counts = generate(args.dbfile, args.restaurants, args.users, args.years, args.turnout, seed=args.seed)
+        sys.stderr.write("Generated %s in %.1fs: %s\n"%(args.dbfile, default_timer() - started,
+                         ", ".join("%d %s"%(V, K) for K, V in sorted(counts.items()))))
+        if args.command == "generate":
+            return
+
+    results = benchmark(args.dbfile, args.repeat)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as F:
+            F.write(output + "\n")
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
@@ -2,32 +2,158 @@ import json
 import os
 from datetime import time
 
+class Frozen(dict):
+	'''A dict that can't be changed once built; the settings are swapped whole instead'''
+	def _readonly(self, *args, **kwargs):
+		raise TypeError("Settings are read-only")
+	__setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+#Checks for each kind of setting: each returns the parsed value or raises ValueError
+
+def _text(value):
+	if not isinstance(value, basestring):
+		raise ValueError("expected a string, not %r"%(value,))
+	return value
+
+def _word(value):
+	#An sqlite pragma keyword such as WAL
+	if not _text(value).isalpha():
+		raise ValueError("expected a single word, not %r"%(value,))
+	return value
+
+def _flag(value):
+	if not isinstance(value, bool):
+		raise ValueError("expected true or false, not %r"%(value,))
+	return value
+
+def _integer(low=None, high=None):
+	def check(value):
+		if isinstance(value, bool) or not isinstance(value, (int, long)):
+			raise ValueError("expected a whole number, not %r"%(value,))
+		if (low is not None and value < low) or (high is not None and value > high):
+			raise ValueError("%d is out of range"%value)
+		return value
+	return check
+
+def _number(value):
+	#A positive number of seconds, or a rate
+	if isinstance(value, bool) or not isinstance(value, (int, long, float)) or value <= 0:
+		raise ValueError("expected a positive number, not %r"%(value,))
+	return value
+
+def _optional(check):
+	def optional(value):
+		return None if value is None else check(value)
+	return optional
+
+def _clock(value):
+	#[Hour, Minute] on a 24h clock
+	if not isinstance(value, list) or len(value) != 2:
+		raise ValueError("expected [hour, minute], not %r"%(value,))
+	return time(_integer(0, 23)(value[0]), _integer(0, 59)(value[1]))
+
+def _days(value):
+	#Days of the week, 0=Monday
+	if not isinstance(value, list):
+		raise ValueError("expected a list of days, not %r"%(value,))
+	return tuple(_integer(0, 6)(D) for D in value)
+
+def _schedules(value):
+	#[{"days": [...], "start": [H,M], "end": [H,M]}, ...] as ((days, start, end), ...)
+	if not isinstance(value, list):
+		raise ValueError("expected a list of windows, not %r"%(value,))
+	schedules = []
+	for S in value:
+		if not isinstance(S, dict):
+			raise ValueError("expected a window like {\"days\": [3], \"start\": [9,30], \"end\": [11,0]}, not %r"%(S,))
+		schedules.append((_days(S.get('days')), _clock(S.get('start')), _clock(S.get('end'))))
+	return tuple(schedules)
+
+#Every setting and its check; a setting left out of the file gets its default from _defaults
+SCHEMA = {
+	"lunch": {
+		"hostname": _text, "dbfile": _text, "templates": _text,
+		"norepeat": _integer(0), "ballot_size": _integer(1), "tiers": _integer(1),
+		"time_days": _days, "time_start": _clock, "time_end": _clock,
+		"schedules": _optional(_schedules),
+	},
+	"server": {"host": _text, "port": _integer(1, 65535), "reuse_port": _flag},
+	"cluster": {"lease": _number, "poll": _number},
+	"database": {
+		"journal_mode": _word, "synchronous": _word, "cache_size": _integer(), "mmap_size": _integer(0),
+		"busy_timeout": _integer(0), "pool_size": _integer(1), "max_overflow": _integer(0),
+	},
+	"smtp": {
+		"server": _text, "port": _integer(1, 65535), "user": _text, "pass": _text,
+		"per_connection": _integer(1), "rate": _optional(_number), "workers": _integer(1),
+		"retries": _integer(1), "backoff": _number, "starttls": _flag, "login": _flag,
+	},
+}
+
 class LunchConfig(object):
+	'''
+	The settings in a lunchconfig.json, checked and parsed once into
+	read-only values (times as datetime.time, lists as tuples), so reading
+	one costs nothing.
+
+	reload() re-reads the file if it has changed since and swaps in the new
+	settings in one step, so a reader sees either all old or all new ones.
+	If the file is broken the settings in use are kept (see ConfigPlugin).
+	'''
 	_defaults = '''{
 	  "lunch": {
 	  	"hostname"   : "localhost",
 	    "dbfile"     : "lunch.db",
+	    "templates"  : "templates",
 	    "norepeat"   : 21,
+	    "ballot_size": 5,
+	    "tiers"      : 3,
 	    "time_days"  : [3],
 	    "time_start" : [9,30],
-	    "time_end"   : [11,0]
+	    "time_end"   : [11,0],
+	    "schedules"  : null
+	  },
+
+	  "server": {
+	    "host"       : "0.0.0.0",
+	    "port"       : 8080,
+	    "reuse_port" : false
+	  },
+
+	  "cluster": {
+	    "lease"      : 30,
+	    "poll"       : 5
+	  },
+
+	  "database": {
+	    "journal_mode" : "WAL",
+	    "synchronous"  : "NORMAL",
+	    "cache_size"   : -20000,
+	    "mmap_size"    : 268435456,
+	    "busy_timeout" : 5000,
+	    "pool_size"    : 10,
+	    "max_overflow" : 10
 	  },
 
 	  "smtp": {
 	    "server"     : "smtpserver",
 	    "port"       : 465,
 	    "user"       : "user",
-	    "pass"       : "password"
+	    "pass"       : "password",
+	    "per_connection" : 50,
+	    "rate"       : 5,
+	    "workers"    : 2,
+	    "retries"    : 5,
+	    "backoff"    : 60,
+	    "starttls"   : true,
+	    "login"      : true
 	  }
 	}'''
 
 	def __init__(self, cfgfile="lunchconfig.json"):
-		self.config = json.loads(self._defaults)
 		self.cfgfile = cfgfile
-
-		if os.path.exists(cfgfile):
-			with open(cfgfile,'r') as F:
-				self.config = json.load(F)
+		self.mtime = self.modified()
+		self.config, self.settings = self.read()
 
 	def __str__(self):
 		return str(self.config)	
@@ -36,44 +162,149 @@ class LunchConfig(object):
 		with open(self.cfgfile,'w') as F:
 			F.write(json.dumps(self.config, indent=2))
 
+	def modified(self):
+		#The file's modification time and size, or None if there is no file
+		try:
+			stat = os.stat(self.cfgfile)
+		except OSError:
+			return None
+		return (stat.st_mtime, stat.st_size)
+
+	def read(self):
+		#Returns the file's JSON and its parsed settings, or raises ValueError saying what's wrong
+		config = json.loads(self._defaults)
+		if os.path.exists(self.cfgfile):
+			try:
+				with open(self.cfgfile,'r') as F:
+					config = json.load(F)
+			except IOError, e:
+				raise ValueError("can't read %s: %s"%(self.cfgfile, e))
+			except ValueError, e:
+				raise ValueError("%s isn't valid JSON: %s"%(self.cfgfile, e))
+		return config, self.parse(config)
+
+	def parse(self, config):
+		'''Checks a config and returns its settings: a Frozen dict of Frozen sections'''
+		if not isinstance(config, dict):
+			raise ValueError("the config must be a JSON object")
+		defaults = json.loads(self._defaults)
+		settings = {}
+		for section, checks in SCHEMA.items():
+			given = config.get(section, {})
+			if not isinstance(given, dict):
+				raise ValueError("%s: expected an object"%section)
+			values = {}
+			for key, check in checks.items():
+				try:
+					values[key] = check(given.get(key, defaults[section][key]))
+				except ValueError, e:
+					raise ValueError("%s.%s: %s"%(section, key, e))
+			settings[section] = values
+
+		#The time_* settings make up the one voting window when there's no schedules list
+		lunch = settings["lunch"]
+		if not lunch["schedules"]:
+			lunch["schedules"] = ((lunch["time_days"], lunch["time_start"], lunch["time_end"]),)
+		for days, start, end in lunch["schedules"]:
+			if start >= end:
+				raise ValueError("lunch: a voting window ends (%s) before it starts (%s)"%(end, start))
+		return Frozen((section, Frozen(values)) for section, values in settings.items())
+
+	def reload(self):
+		'''
+		Re-reads the file if it has changed, and returns which settings
+		changed as {section: [keys]}. Raises ValueError, keeping the
+		current settings, if the file is broken or has gone.
+		'''
+		mtime = self.modified()
+		if mtime == self.mtime:
+			return {}
+		self.mtime = mtime
+		if mtime is None:
+			raise ValueError("%s has gone"%self.cfgfile)
+		config, settings = self.read()
+
+		changed = {}
+		for section, values in settings.items():
+			keys = sorted(K for K in values if values[K] != self.settings[section][K])
+			if keys:
+				changed[section] = keys
+		self.config, self.settings = config, settings
+		return changed
+
 	@property 
 	def dbfile(self): 
-		return self.config['lunch']['dbfile']
+		return self.settings['lunch']['dbfile']
 
 	@property 
 	def hostname(self): 
-		return self.config['lunch']['hostname']
+		return self.settings['lunch']['hostname']
+
+	@property 
+	def templates(self): 
+		return self.settings['lunch']['templates']
 
 	@property 
 	def norepeat(self): 
-		return self.config['lunch']['norepeat']
+		return self.settings['lunch']['norepeat']
+
+	@property 
+	def ballot_size(self): 
+		return self.settings['lunch']['ballot_size']
+
+	@property 
+	def tiers(self): 
+		return self.settings['lunch']['tiers']
 
 	@property 
 	def time_days(self): 
-		return self.config['lunch']['time_days']
+		return self.settings['lunch']['time_days']
 
 	@property 
 	def time_start(self): 
-		return time(*self.config['lunch']['time_start'])
+		return self.settings['lunch']['time_start']
 
 	@property 
 	def time_end(self): 
-		return time(*self.config['lunch']['time_end'])
+		return self.settings['lunch']['time_end']
 
 	@property
-	def smtp(self): 
-		return self.config['smtp']	
+	def schedules(self): 
+		#The (days, start time, end time) voting windows; from the time_* settings if there's no schedules list
+		return self.settings['lunch']['schedules']
+
+	@property
+	def server(self): 
+		return self.settings['server']
+
+	@property
+	def cluster(self): 
+		return self.settings['cluster']
+
+	@property
+	def database(self): 
+		return self.settings['database']
 
+	@property
+	def smtp(self): 
+		return self.settings['smtp']
 
 def main():	
 	cfg = LunchConfig("lunchconfig_defaults.json")
 	cfg.save()
 	print "hostname      ",cfg.hostname
 	print "dbfile        ",cfg.dbfile
+	print "templates     ",cfg.templates
 	print "norepeat      ",cfg.norepeat
+	print "ballot_size   ",cfg.ballot_size
+	print "tiers         ",cfg.tiers
 	print "time_days     ",cfg.time_days
 	print "time_start    ",cfg.time_start
 	print "time_end      ",cfg.time_end
+	print "schedules     ",cfg.schedules
+	print "server        ",cfg.server
+	print "cluster       ",cfg.cluster
+	print "database      ",cfg.database
 	print "smtp          ",cfg.smtp
 
 if __name__ == '__main__':
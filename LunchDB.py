@@ -3,23 +3,27 @@ import sqlite3
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy import create_engine
 from sqlalchemy import event
-from sqlalchemy import Column, Integer, String, Float, Date, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, Date, DateTime, Boolean, ForeignKey, Text, Index
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.expression import func, or_
 from sqlalchemy.schema import Table
+from sqlalchemy.pool import QueuePool
 import os, os.path
 from datetime import datetime
 
 Base=declarative_base()
 Session=sessionmaker()
 
-__all__ = ['Restaurant', 'User', 'Event', 'Choice', 'Vote', 'LunchDB']
+__all__ = ['Restaurant', 'User', 'Event', 'Choice', 'Vote', 'RestaurantRating', 'UserRating', 'EventResult', 'EventWindow', 'Lease', 'VoteRequest', 'Outbox', 'LunchDB']
 
 #TABLE: list of restaurants
 class Restaurant(Base):
     __tablename__ = 'restaurants'
+    __table_args__ = (Index('ix_restaurants_enabled_rank', 'enabled', 'rank', 'last'),)
     id = Column(Integer, primary_key=True)
-    name = Column(String(250), nullable=False)  #Restaurant Name
+    name = Column(String(250), nullable=False, unique=True, index=True)  #Restaurant Name
     rank = Column(Float, default=0.0)          #Current Rank (updated after each event)
     visits = Column(Integer, default=0)         #Number of visits (ie: number of votes won)
     last = Column(Date, default=datetime(1900,1,1)) #Date of last visit (if applicable)
@@ -35,7 +39,7 @@ class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
     name = Column(String(250))  #User's name
-    email = Column(String(250)) #User's email address
+    email = Column(String(250), unique=True, index=True) #User's email address
     tb_count = Column(Integer, default=0) #Number of times this user was used to break a tie
 
     def __repr__(self):
@@ -43,16 +47,20 @@ class User(Base):
 
 #TABLE: list of vote events
 #   with relationship to the choices and votes for this event
+#   The winner and tiebreaker are joined into every Event query, and the choices of
+#   all the events a query returns are loaded by one more query, so listing events
+#   doesn't cost a query per event. The votes are only loaded when asked for.
 class Event(Base):
     __tablename__ = 'events'
+    __table_args__ = (Index('ix_events_date_id', 'date', 'id'),)
     id = Column(Integer, primary_key=True)
     date = Column(Date, default=func.now())   #Date of event
     winner_id = Column(Integer, ForeignKey(Restaurant.id))
     tiebreaker_id = Column(Integer, ForeignKey(User.id))
     
-    winner = relationship("Restaurant")
-    tiebreaker = relationship("User")
-    choices = relationship("Choice", backref="Event")
+    winner = relationship("Restaurant", lazy="joined")
+    tiebreaker = relationship("User", lazy="joined")
+    choices = relationship("Choice", backref="Event", lazy="selectin", order_by="Choice.num")
     votes = relationship("Vote", backref="Event")
 
     def __repr__(self):
@@ -61,6 +69,7 @@ class Event(Base):
 #TABLE: List of the choices mapped to vote events (each event has several)
 class Choice(Base):
     __tablename__ = 'choices'
+    __table_args__ = (Index('ix_choices_event_num', 'event', 'num'),)
     id = Column(Integer, primary_key=True) 
     num = Column(Integer)
     event = Column(Integer, ForeignKey(Event.id))
@@ -72,20 +81,238 @@ class Choice(Base):
 #TABLE: list of individual votes, tied to a specific Event/Restaurant
 class Vote(Base):
     __tablename__ = 'votes'
+    __table_args__ = (Index('ix_votes_event_user', 'event', 'user'),)
     id = Column(Integer, primary_key=True)
     event = Column(Integer, ForeignKey(Event.id))
-    restaurant = Column(Integer, ForeignKey(Restaurant.id))
-    user  = Column(Integer, ForeignKey(User.id))
+    restaurant = Column(Integer, ForeignKey(Restaurant.id), index=True)
+    user  = Column(Integer, ForeignKey(User.id), index=True)
     rank = Column(Integer)    
 
     def __repr__(self):
         return "<Vote (evt %d) Rest %d=%d by %s>"%(self.event,self.restaurant,self.rank,self.user)
 
+#Columns shared by the rating histogram tables: a count of 1-5 star votes
+class RatingHistogram(object):
+    r1 = Column(Integer, default=0, nullable=False)
+    r2 = Column(Integer, default=0, nullable=False)
+    r3 = Column(Integer, default=0, nullable=False)
+    r4 = Column(Integer, default=0, nullable=False)
+    r5 = Column(Integer, default=0, nullable=False)
+
+    @property
+    def histogram(self):
+        return [self.r1 or 0, self.r2 or 0, self.r3 or 0, self.r4 or 0, self.r5 or 0]
+
+#TABLE: histogram of all votes cast for each restaurant (kept in step with the votes table)
+class RestaurantRating(RatingHistogram, Base):
+    __tablename__ = 'restaurant_ratings'
+    restaurant = Column(Integer, ForeignKey(Restaurant.id), primary_key=True)
+
+    def __repr__(self):
+        return "<RestaurantRating Rest %d=%s>"%(self.restaurant, self.histogram)
+
+#TABLE: histogram of each user's votes for each restaurant (kept in step with the votes table)
+class UserRating(RatingHistogram, Base):
+    __tablename__ = 'user_ratings'
+    user = Column(Integer, ForeignKey(User.id), primary_key=True)
+    restaurant = Column(Integer, ForeignKey(Restaurant.id), primary_key=True)
+
+    def __repr__(self):
+        return "<UserRating Rest %d=%s by %s>"%(self.restaurant, self.histogram, self.user)
+
+#TABLE: the final Schulze results of each closed event, stored when it closes
+class EventResult(Base):
+    __tablename__ = 'event_results'
+    event = Column(Integer, ForeignKey(Event.id), primary_key=True)
+    winner = Column(String(250))    #Winning restaurant name (None if nobody voted)
+    data = Column(Text)             #JSON encoded results: see LunchVote.encodeResults
+
+    def __repr__(self):
+        return "<EventResult (evt %d) Win: %s>"%(self.event, self.winner)
+
+#TABLE: when voting opened and closes for each event. This is where every lunch.py
+#process finds the open event, and it lets an open event survive a restart
+class EventWindow(Base):
+    __tablename__ = 'event_windows'
+    event = Column(Integer, ForeignKey(Event.id), primary_key=True)
+    opens = Column(DateTime, nullable=False)    #When voting opened
+    closes = Column(DateTime, nullable=False)   #When voting closes
+    closed = Column(Boolean, default=False, nullable=False, index=True)  #True once the results are in
+    ballots = Column(Integer, default=0, nullable=False)    #Ballots written so far, by any process
+
+    def __repr__(self):
+        return "<EventWindow (evt %d) %s - %s%s>"%(self.event, self.opens, self.closes, " closed" if self.closed else "")
+
+#TABLE: named leases; the process holding the "manager" lease runs the vote schedule
+class Lease(Base):
+    __tablename__ = 'leases'
+    name = Column(String(50), primary_key=True)
+    holder = Column(String(250), nullable=False)    #host:pid:id of the process holding it
+    expires = Column(DateTime, nullable=False)      #Anyone may take it after this
+
+    def __repr__(self):
+        return "<Lease %s held by %s until %s>"%(self.name, self.holder, self.expires)
+
+#TABLE: votes started from the admin page, waiting for the process running the schedule
+class VoteRequest(Base):
+    __tablename__ = 'vote_requests'
+    id = Column(Integer, primary_key=True)
+    closes = Column(DateTime)   #None to close at the end of the scheduled window
+    created = Column(DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return "<VoteRequest %d closing %s>"%(self.id, self.closes)
+
+#TABLE: outgoing mail, queued here and delivered by the mail queue workers
+class Outbox(Base):
+    __tablename__ = 'outbox'
+    __table_args__ = (Index('ix_outbox_status_next_try', 'status', 'next_try'),)
+    id = Column(Integer, primary_key=True)
+    toaddr = Column(Text, nullable=False)   #Comma-separated recipient list
+    subject = Column(String(500))
+    body = Column(Text)
+    html = Column(Boolean, default=True, nullable=False)
+    status = Column(String(10), default="queued", nullable=False)   #queued, sending, sent or failed
+    holder = Column(String(250))    #host:pid:id of the mail queue sending it
+    claimed = Column(DateTime)      #When it was last claimed for sending
+    attempts = Column(Integer, default=0, nullable=False)
+    next_try = Column(DateTime, default=datetime.now)   #Don't retry before this time
+    created = Column(DateTime, default=datetime.now)
+    sent = Column(DateTime)
+    error = Column(Text)    #Last delivery error
+
+    def __repr__(self):
+        return "<Outbox %d %s to %s>"%(self.id, self.status, self.toaddr)
+
+#Production settings for the sqlite engine; override these in the
+#"database" section of lunchconfig.json
+SQLITE_PROFILE = {
+    "journal_mode" : "WAL",         #Readers don't block the writer (or each other)
+    "synchronous"  : "NORMAL",      #Safe with WAL, and far fewer fsyncs than FULL
+    "cache_size"   : -20000,        #Page cache per connection; negative is KiB
+    "mmap_size"    : 268435456,     #Bytes of the db file to memory-map
+    "busy_timeout" : 5000,          #ms to wait for a lock before "database is locked"
+    "pool_size"    : 10,            #Pooled connections; one per server thread
+    "max_overflow" : 10,            #Extra connections for the Manager, mail workers, etc.
+}
+
+def profileSettings(profile=None):
+    #SQLITE_PROFILE updated with any profile overrides
+    settings = dict(SQLITE_PROFILE)
+    settings.update(profile or {})
+    for key in ["journal_mode", "synchronous"]:
+        if not str(settings[key]).isalpha():
+            raise ValueError("Bad sqlite %s: %s"%(key, settings[key]))
+    return settings
+
+def createEngine(dbfile, profile=None):
+    '''
+    Creates the engine for a sqlite dbfile, applying the SQLITE_PROFILE
+    pragmas (updated with any profile overrides) to each new connection.
+    Create one engine per process and share it.
+    '''
+    settings = profileSettings(profile)
+    engine = create_engine('sqlite:///'+dbfile,
+        poolclass=QueuePool, pool_size=int(settings["pool_size"]), max_overflow=int(settings["max_overflow"]),
+        connect_args={"check_same_thread":False})
+    engine.sqlite_profile = settings
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        settings = engine.sqlite_profile
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=%s"%settings["journal_mode"])
+        cursor.execute("PRAGMA synchronous=%s"%settings["synchronous"])
+        cursor.execute("PRAGMA cache_size=%d"%int(settings["cache_size"]))
+        cursor.execute("PRAGMA mmap_size=%d"%int(settings["mmap_size"]))
+        cursor.execute("PRAGMA busy_timeout=%d"%int(settings["busy_timeout"]))
+        cursor.close()
+
+    return engine
+
+def reprofile(engine, profile):
+    '''
+    Applies new profile overrides to an engine made by createEngine. The
+    pooled connections are closed, so each connection from now on is opened
+    with the new pragmas; connections in use are closed when they're
+    returned. pool_size and max_overflow only change on a restart.
+    '''
+    engine.sqlite_profile = profileSettings(profile)
+    engine.dispose()
+
 class LunchDB(object):
-    def __init__(self, dbfile):
-        self.engine = create_engine('sqlite:///'+dbfile)
+    def __init__(self, dbfile, profile=None):
+        self.engine = createEngine(dbfile, profile)
         Session.configure(bind=self.engine)
         Base.metadata.create_all(self.engine)
+        upgradeColumns(self.engine)
+        upgradeIndexes(self.engine)
+
+def upgradeColumns(engine):
+    '''
+    create_all skips tables that already exist, so a lunch.db made before a
+    column was added to the models doesn't have it. Adds any missing
+    columns. The old rows get the column's default where that is a plain
+    value (so a NOT NULL counter starts at 0, not NULL), and NULL otherwise.
+    '''
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(C["name"] for C in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute("ALTER TABLE %s ADD COLUMN %s %s"%(
+                    table.name, column.name, column.type.compile(dialect=engine.dialect)))
+                if column.default is not None and column.default.is_scalar:
+                    engine.execute(table.update().values({column.name: column.default.arg}))
+
+def upgradeIndexes(engine):
+    '''
+    create_all skips tables that already exist, so a lunch.db made before an
+    index was added to the models never gets it. Creates any missing indexes
+    and returns the names of the ones that couldn't be built (a unique index
+    over duplicate data); remove the duplicates and restart to add those.
+    '''
+    failed = []
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(I["name"] for I in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            try:
+                index.create(engine)
+            except IntegrityError, e:
+                print "WARNING: can't create unique index %s, %s has duplicate rows: %s"%(index.name, table.name, e.orig)
+                failed.append(index.name)
+    return failed
+
+#Hot queries and the index each one should use, checked by queryPlans()
+INDEXED_QUERIES = [
+    ("user by email",               lambda db: db.query(User).filter(User.email=="jtest@test.com"),             "ix_users_email"),
+    ("restaurant by name",          lambda db: db.query(Restaurant).filter(Restaurant.name=="Pizza"),          "ix_restaurants_name"),
+    ("votes for an event",          lambda db: db.query(Vote).filter(Vote.event==1),                           "ix_votes_event_user"),
+    ("votes for an event and user", lambda db: db.query(Vote).filter(Vote.event==1, Vote.user==1),             "ix_votes_event_user"),
+    ("votes for a restaurant",      lambda db: db.query(Vote.rank).filter(Vote.restaurant==1),                 "ix_votes_restaurant"),
+    ("choices for an event",        lambda db: db.query(Restaurant.name).join(Choice).filter(Choice.event==1).order_by(Choice.num), "ix_choices_event_num"),
+    ("eligible restaurants by rank", lambda db: db.query(Restaurant.id).filter(Restaurant.enabled==True, Restaurant.last<=datetime(2000,1,1)).order_by(Restaurant.rank.desc()), "ix_restaurants_enabled_rank"),
+    ("event history page",          lambda db: db.query(Event.id).filter(Event.date<=datetime(2000,1,1), or_(Event.date<datetime(2000,1,1), Event.id<10)).order_by(Event.date.desc(), Event.id.desc()).limit(10), "ix_events_date_id"),
+    ("mail that is due",            lambda db: db.query(Outbox.id).filter(Outbox.status=="queued", Outbox.next_try<=datetime.now()), "ix_outbox_status_next_try"),
+]
+
+def explain(db, query):
+    '''Returns the sqlite EXPLAIN QUERY PLAN detail lines for an ORM query'''
+    compiled = query.statement.compile()
+    return [R[-1] for R in db.execute(text("EXPLAIN QUERY PLAN "+str(compiled)), compiled.params)]
+
+def queryPlans(db):
+    '''Checks that each of the INDEXED_QUERIES uses its index.
+    Returns a list of problem descriptions (empty if they all do)'''
+    errors = []
+    for desc, query, index in INDEXED_QUERIES:
+        plan = explain(db, query(db))
+        if not any(index in line for line in plan):
+            errors.append("%s doesn't use %s: %s"%(desc, index, "; ".join(plan)))
+    return errors
 
 
 #
@@ -206,5 +433,13 @@ def main():
     lprint("list of all votes for a single event and user, by restaurant name and choice number",
         db.query(Vote.user, Vote.rank).join(Choice, Choice.restaurant==Vote.restaurant).filter(Vote.user==uid, Vote.event==eid).all())
 
+    #
+    # Query plans: the hot queries should all be index lookups
+    #
+
+    errors = queryPlans(db)
+    lprint("queries that don't use their index", errors)
+    assert not errors
+
 if __name__ == '__main__':
     main()
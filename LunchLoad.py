@@ -0,0 +1,335 @@
+#!/usr/bin/python
+'''
+Load test of a vote stampede: what happens when an invitation blast makes
+everyone open /vote and vote at once.
+
+  LunchLoad.py [--users N] [--voters N] [--concurrency N] [--mail-rate N] [--output results.json]
+
+It generates a dataset (see LunchBench.generate) in a temporary directory,
+starts lunch.py on it with its mail pointed at a local SMTP sink, and starts
+a vote from the admin page. Each voter waits for their invitation to
+arrive at the sink, follows its link to /vote and posts a ballot, with up
+to `concurrency` voters at a time. Once every voter is done the vote is
+ended from the admin page and the harness waits for the winner.
+
+It reports latency percentiles and errors ("database is locked" counted
+apart) for the vote page and ballot posts, mail throughput, and the time
+from starting the vote to the winner, as JSON.
+'''
+from LunchBench import generate
+
+import argparse
+import asyncore
+import json
+import math
+import os, os.path
+import random
+import re
+import shutil
+import signal
+import smtpd
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+from Queue import Queue, Empty
+from email import message_from_string
+
+__all__ = ['SMTPSink', 'LoadTest']
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def freePort():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def percentile(values, p):
+    #Nearest-rank percentile of a list of numbers
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p/100.0*len(values))) - 1)]
+
+class SMTPSink(smtpd.SMTPServer):
+    '''
+    An SMTP server that keeps nothing: it records when each message
+    arrived and hands the voting links in invitations to a queue.
+    Run it with start(); it serves from a thread of its own.
+    '''
+    def __init__(self, port):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", port), None)
+        self.lock = threading.Lock()
+        self.received = []      #(time, subject, recipients)
+        self.links = Queue()
+        self.thread = None
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        msg = message_from_string(data)
+        with self.lock:
+            self.received.append((time.time(), msg["Subject"], len(rcpttos)))
+        for part in msg.walk():
+            if part.get_content_type() == "text/html":
+                for link in re.findall(r'href="([^"]*/vote\?u=[^"]*)"', part.get_payload(decode=True)):
+                    self.links.put((time.time(), link))
+
+    def start(self):
+        self.thread = threading.Thread(target=asyncore.loop, kwargs={"timeout":0.1, "map":self._map}, name="SMTPSink")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def count(self, subject):
+        #Messages and recipients received so far whose subject starts with `subject`
+        with self.lock:
+            found = [R for R in self.received if (R[1] or "").startswith(subject)]
+        return len(found), sum(R[2] for R in found), [R[0] for R in found]
+
+class LoadTest(object):
+    def __init__(self, workdir, users=500, voters=None, concurrency=50, mail_rate=None, mail_workers=2,
+                 restaurants=100, years=1, timeout=300):
+        self.workdir = workdir
+        self.users = users
+        self.voters = users if voters is None else min(voters, users)
+        self.concurrency = concurrency
+        self.mail_rate = mail_rate
+        self.mail_workers = mail_workers
+        self.restaurants = restaurants
+        self.years = years
+        self.timeout = timeout
+
+        self.port = freePort()
+        self.base = "http://127.0.0.1:%d"%self.port
+        self.sink = SMTPSink(freePort())
+        self.server = None
+        self.lock = threading.Lock()
+        self.latencies = {"vote_page":[], "vote_post":[]}
+        self.errors = {"vote_page":{}, "vote_post":{}}
+        auth = urllib2.HTTPDigestAuthHandler()
+        auth.add_password("lunch", self.base, "admin", "admin")
+        self.admin = urllib2.build_opener(auth)
+
+    def setup(self):
+        '''Writes the dataset and a lunchconfig.json for lunch.py to run in workdir'''
+        started = time.time()
+        counts = generate(os.path.join(self.workdir, "lunch.db"), self.restaurants, self.users, self.years,
+                          open_event=False)
+        with open(os.path.join(HERE, "lunchconfig_defaults.json")) as F:
+            config = json.load(F)
+        config["lunch"].update({"dbfile":"lunch.db", "templates":os.path.join(HERE, "templates"),
+                                "hostname":"127.0.0.1:%d"%self.port, "time_days":[]})
+        config["server"] = {"host":"127.0.0.1", "port":self.port}
+        config["cluster"] = {"lease":30, "poll":1}
+        config["smtp"].update({"server":"127.0.0.1", "port":self.sink.addr[1], "starttls":False, "login":False,
+                               "rate":self.mail_rate, "workers":self.mail_workers})
+        with open(os.path.join(self.workdir, "lunchconfig.json"), "w") as F:
+            json.dump(config, F, indent=2)
+        os.symlink(os.path.join(HERE, "static"), os.path.join(self.workdir, "static"))
+        sys.stderr.write("Generated %d users and %d votes in %.1fs\n"%(counts["users"], counts["votes"], time.time() - started))
+
+    def startServer(self):
+        self.log = open(os.path.join(self.workdir, "lunch.log"), "w")
+        self.server = subprocess.Popen([sys.executable, os.path.join(HERE, "lunch.py")], cwd=self.workdir,
+                                       stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            if self.server.poll() is not None:
+                raise RuntimeError("lunch.py exited; see %s"%self.log.name)
+            try:
+                urllib2.urlopen(self.base + "/", timeout=1).read()
+                return
+            except (urllib2.URLError, socket.error):
+                time.sleep(0.2)
+        raise RuntimeError("lunch.py didn't start; see %s"%self.log.name)
+
+    def stopServer(self):
+        if self.server is not None and self.server.poll() is None:
+            self.server.send_signal(signal.SIGTERM)
+            for i in range(100):
+                if self.server.poll() is not None:
+                    break
+                time.sleep(0.1)
+            else:
+                self.server.kill()
+        self.server = None
+
+    def request(self, kind, url, data=None):
+        '''Fetches a page, recording its latency or what went wrong; returns the page or None'''
+        started = time.time()
+        error = None
+        try:
+            page = urllib2.urlopen(url, data, timeout=60).read()
+        except urllib2.HTTPError as e:
+            body = e.read()
+            error = "database is locked" if "database is locked" in body else "HTTP %d"%e.code
+        except (urllib2.URLError, socket.error) as e:
+            error = "connection: %s"%getattr(e, "reason", e)
+        with self.lock:
+            if error is None:
+                self.latencies[kind].append(time.time() - started)
+            else:
+                self.errors[kind][error] = self.errors[kind].get(error, 0) + 1
+        return page if error is None else None
+
+    def vote(self, link):
+        #One voter: open the emailed link, then rank every choice
+        url = self.base + link[link.index("/vote"):]
+        page = self.request("vote_page", url)
+        if page is None:
+            return
+        choices = sorted(set(re.findall(r'name="(c\d+)"', page)))
+        if not choices:
+            with self.lock:
+                self.errors["vote_page"]["no ballot"] = self.errors["vote_page"].get("no ballot", 0) + 1
+            return
+        ballot = dict((C, random.randint(1, 5)) for C in choices)
+        ballot.update({"u":urllib.unquote(url.split("u=", 1)[1]), "action":"vote"})
+        page = self.request("vote_post", self.base + "/vote", urllib.urlencode(ballot))
+        if page is not None and "received!" not in page:
+            with self.lock:
+                self.errors["vote_post"]["not received"] = self.errors["vote_post"].get("not received", 0) + 1
+
+    def voter(self, pending):
+        while True:
+            try:
+                link = pending.get(timeout=1)
+            except Empty:
+                if self.finished.is_set():
+                    return
+                continue
+            self.vote(link)
+            with self.lock:
+                self.voted += 1
+                if self.voted >= self.voters:
+                    self.finished.set()
+
+    def run(self):
+        self.sink.start()
+        self.setup()
+        self.startServer()
+        try:
+            return self.stampede()
+        finally:
+            self.stopServer()
+            self.log.close()
+
+    def stampede(self):
+        timings = {}
+        self.voted = 0
+        self.finished = threading.Event()
+        pending = Queue()
+        threads = [threading.Thread(target=self.voter, args=(pending,), name="Voter-%d"%i) for i in range(self.concurrency)]
+        for T in threads:
+            T.daemon = True
+            T.start()
+
+        #Start the vote, then pass the first `voters` invitations on to the voters as they arrive
+        started = time.time()
+        self.admin.open(self.base + "/admin", urllib.urlencode({"action":"start_vote", "close":""}), timeout=60).read()
+        deadline = started + self.timeout
+        invited = 0
+        first = None
+        while invited < self.users and time.time() < deadline:
+            try:
+                arrived, link = self.sink.links.get(timeout=1)
+            except Empty:
+                continue
+            first = first or arrived
+            if invited < self.voters:
+                pending.put(link)
+            invited += 1
+        timings["first_invitation"] = first - started if first else None
+        timings["all_invitations"] = time.time() - started if invited >= self.users else None
+
+        self.finished.wait(max(0, deadline - time.time()))
+        timings["all_votes"] = time.time() - started if self.finished.is_set() else None
+        self.finished.set()
+        for T in threads:
+            T.join(5)
+
+        #End the vote and wait for the winner
+        self.admin.open(self.base + "/admin", urllib.urlencode({"action":"end_vote"}), timeout=60).read()
+        winner = None
+        while winner is None and time.time() < deadline:
+            page = urllib2.urlopen(self.base + "/results", timeout=60).read()
+            found = re.search(r"<h2>Winner: (.*?)</h2>", page)
+            if found and self.sink.count("Lunch Vote Closed")[0]:
+                winner = found.group(1)
+            else:
+                time.sleep(0.2)
+        timings["winner"] = time.time() - started if winner else None
+
+        messages, recipients, arrivals = self.sink.count("Lunch Vote Open")
+        mail = {"invitations":messages, "seconds":max(arrivals) - min(arrivals) if arrivals else None}
+        mail["per_second"] = messages/mail["seconds"] if mail["seconds"] else None
+        mail["results_recipients"] = self.sink.count("Lunch Vote Closed")[1]
+
+        requests = {}
+        for kind, latencies in self.latencies.items():
+            failed = sum(self.errors[kind].values())
+            total = len(latencies) + failed
+            requests[kind] = {"count":total, "errors":self.errors[kind],
+                              "error_rate":float(failed)/total if total else None,
+                              "p50":percentile(latencies, 50), "p99":percentile(latencies, 99),
+                              "max":max(latencies) if latencies else None}
+        elapsed = (timings["all_votes"] or time.time() - started) - (timings["first_invitation"] or 0)
+        return {"users":self.users, "voters":self.voters, "concurrency":self.concurrency,
+                "mail_rate":self.mail_rate, "mail_workers":self.mail_workers,
+                "winner":winner, "seconds":timings, "requests":requests, "mail":mail,
+                "ballots_per_second":len(self.latencies["vote_post"])/elapsed if elapsed > 0 else None}
+
+def report(results):
+    #A readable summary of the results, for stderr
+    lines = ["%d voters of %d users, %d at a time"%(results["voters"], results["users"], results["concurrency"])]
+    for kind, R in sorted(results["requests"].items()):
+        lines.append("%-10s %5d requests  p50 %s  p99 %s  errors %s"%(kind, R["count"],
+                     "%.0fms"%(R["p50"]*1000) if R["p50"] is not None else "-",
+                     "%.0fms"%(R["p99"]*1000) if R["p99"] is not None else "-",
+                     ", ".join("%d %s"%(V, K) for K, V in sorted(R["errors"].items())) or "none"))
+    mail = results["mail"]
+    lines.append("mail       %d invitations at %s/s"%(mail["invitations"], "%.1f"%mail["per_second"] if mail["per_second"] else "-"))
+    lines.append("timeline   " + ", ".join("%s %s"%(K, "%.1fs"%V if V is not None else "timed out")
+                                           for K, V in sorted(results["seconds"].items(), key=lambda T: T[1] or 1e9)))
+    lines.append("winner     %s"%results["winner"])
+    return "\n".join(lines) + "\n"
+
+def main():
+    parser = argparse.ArgumentParser(description="Vote stampede load test")
+    parser.add_argument("--users", type=int, default=500, help="users invited to vote")
+    parser.add_argument("--voters", type=int, help="users who follow their invitation and vote (default all)")
+    parser.add_argument("--concurrency", type=int, default=50, help="voters at a time")
+    parser.add_argument("--mail-rate", type=float, help="smtp rate limit in emails per second (default none)")
+    parser.add_argument("--mail-workers", type=int, default=2)
+    parser.add_argument("--restaurants", type=int, default=100)
+    parser.add_argument("--years", type=float, default=1, help="years of vote history to generate")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to give up after")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory (DB, config and server log)")
+    parser.add_argument("--output", help="write the JSON results here rather than to stdout")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="lunchload-")
+    try:
+        test = LoadTest(workdir, args.users, args.voters, args.concurrency, args.mail_rate, args.mail_workers,
+                        args.restaurants, args.years, args.timeout)
+        results = test.run()
+    finally:
+        if args.keep:
+            sys.stderr.write("Kept %s\n"%workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    sys.stderr.write(report(results))
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as F:
+            F.write(output + "\n")
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,129 @@
 #/usr/bin/python
 import smtplib
+import socket
+import threading
+from time import time, sleep
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
+class Throttle(object):
+	'''Spaces out sends to at most rate per second (None for no limit).
+	One Throttle can be shared by several senders using the same server.'''
+	def __init__(self, rate=None):
+		self.rate = rate
+		self.lock = threading.Lock()
+		self.next = 0
+
+	def wait(self):
+		if not self.rate:
+			return
+		with self.lock:
+			now = time()
+			start = max(now, self.next)
+			self.next = start + 1.0/self.rate
+		if start > now:
+			sleep(start - now)
+
 class LunchMail(object):
-	def __init__(self, server, port, user, password):
+	'''
+	Sends mail over a single authenticated SMTP session, which is reused for
+	up to per_connection messages and reopened transparently if the server
+	drops it. rate limits the messages sent per second (None for no limit),
+	or pass a shared Throttle instead. starttls=False and login=False skip
+	those steps, for a local relay that offers neither.
+	Call close() once a batch of mail has been sent.
+	'''
+	def __init__(self, server, port, user, password, per_connection=50, rate=None, throttle=None,
+				 starttls=True, login=True):
 		self.server = server
 		self.port = port
 		self.user = user
 		self.password = password
+		self.starttls = starttls
+		self.login = login
+		self.per_connection = per_connection
+		self.throttle = throttle if throttle is not None else Throttle(rate)
 
-	def _send(self, fromaddr, toaddr, msg):
-		try: 
-			s = smtplib.SMTP()
-			s.connect(self.server, self.port)
-			# s.set_debuglevel(True)
-			s.ehlo_or_helo_if_needed()
+		self.lock = threading.Lock()
+		self.smtp = None
+		self.count = 0		#Messages sent on the current connection
+
+	def _connect(self):
+		s = smtplib.SMTP()
+		s.connect(self.server, self.port)
+		# s.set_debuglevel(True)
+		s.ehlo_or_helo_if_needed()
+		if self.starttls:
 			s.starttls()
 			s.ehlo_or_helo_if_needed()
+		if self.login:
 			s.login(self.user, self.password)
-			s.sendmail(fromaddr, toaddr, msg.as_string())
-			s.quit()
+		self.smtp = s
+		self.count = 0
+
+	def _close(self):
+		if self.smtp is not None:
+			try:
+				self.smtp.quit()
+			except Exception:
+				pass
+			self.smtp = None
+
+	def close(self):
+		with self.lock:
+			self._close()
+
+	def deliver(self, fromaddr, toaddr, msg):
+		'''Sends a message, raising an exception if it could not be delivered'''
+		with self.lock:
+			self.throttle.wait()
+			try: 
+				for attempt in range(2):
+					if self.smtp is None or self.count >= self.per_connection:
+						self._close()
+						self._connect()
+					try:
+						self.smtp.sendmail(fromaddr, toaddr, msg.as_string())
+						self.count += 1
+						return
+					except (smtplib.SMTPServerDisconnected, socket.error):
+						#The server dropped the session; retry once on a new one
+						self.smtp = None
+						if attempt:
+							raise
+			except Exception:
+				self._close()
+				raise
+
+	def _send(self, fromaddr, toaddr, msg):
+		try:
+			self.deliver(fromaddr, toaddr, msg)
+			return True
 		except Exception, e:
 			print e
+			return False
 
-	def sendhtml(self, toaddr, subject, body, fromaddr=None, alt_text=None, test=False):	
-		if fromaddr is None:
-			fromaddr = self.user			
-		msg = MIMEMultipart('alternative')
+	def message(self, toaddr, subject, body, html=True, alt_text=None):
+		'''Builds the MIME message for sendhtml (html=True) or sendtext'''
+		if html:
+			msg = MIMEMultipart('alternative')
+			msg.attach(MIMEText(body, 'html'))
+			if alt_text is not None:
+				msg.attach(MIMEText(alt_text, 'text'))
+		else:
+			msg = MIMEText(body)
 		msg['Subject'] = subject
 		msg['From'] = self.user
 		msg['To'] = ",".join(toaddr)
-		msg.attach(MIMEText(body, 'html'))
-		if alt_text is not None:
-			msg.attach(MIMEText(alt_text, 'text'))
+		return msg
+
+	def sendhtml(self, toaddr, subject, body, fromaddr=None, alt_text=None, test=False):	
+		if fromaddr is None:
+			fromaddr = self.user			
+		msg = self.message(toaddr, subject, body, True, alt_text)
 		
 		if not test:
-			self._send(fromaddr, toaddr, msg)
+			return self._send(fromaddr, toaddr, msg)
 		else:
 			print "TEST EMAIL:"
 			print "From:    ", fromaddr
@@ -44,17 +131,15 @@ class LunchMail(object):
 			print "Subject: ", subject
 			print "-----"
 			print body
+			return True
 
 	def sendtext(self, toaddr, subject, body, fromaddr=None, test=False):
 		if fromaddr is None:
 			fromaddr = self.user			
-		msg = MIMEText(body)
-		msg['Subject'] = subject
-		msg['From'] = self.user
-		msg['To'] = ",".join(toaddr)
+		msg = self.message(toaddr, subject, body, False)
 
 		if not test:
-			self._send(fromaddr, toaddr, msg)
+			return self._send(fromaddr, toaddr, msg)
 		else:
 			print "TEST EMAIL:"
 			print "From:    ", fromaddr
@@ -63,3 +148,4 @@ class LunchMail(object):
 			print "Subject: ", subject
 			print "-----"
 			print body
+			return True
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+'''
+The HTML pieces the web pages are built from. Pieces with fields are
+string.Templates, in the same $field syntax as the editable email templates
+(see LunchTemplate), compiled once here rather than assembled on every
+request; the shared page header is cached per title as a finished fragment.
+
+Links to static files carry the file's modification time as ?v=, so the
+files can be cached for good (see httpcache.assets) and a changed file is
+fetched again under its new URL, within VERSIONS_TTL seconds.
+
+Pages collect their pieces in a list and join them once, or yield them from
+a generator through chunks() so CherryPy can stream a long page (set
+response.stream) as it is rendered.
+'''
+from string import Template
+import threading
+import time
+import os, os.path
+
+__all__ = ['header', 'footer', 'chunks', 'asset', 'versions']
+
+STATIC_DIR = os.path.join(os.getcwd(), "static")
+
+#Seconds between checks of the static files' modification times
+VERSIONS_TTL = 5
+
+#The static files linked from the header
+HEADER_ASSETS = ["style.css", "apple-touch-icon.png", "favicon-32x32.png", "favicon-16x16.png",
+                 "manifest.json", "safari-pinned-tab.svg", "favicon.ico", "browserconfig.xml"]
+
+HEADER = Template('''<html><head>
+        <title>$pagetitle</title>
+        <link rel="stylesheet" href="$style_css"/>
+        <link rel="apple-touch-icon" sizes="180x180" href="$apple_touch_icon_png">
+        <link rel="icon" type="image/png" sizes="32x32" href="$favicon_32x32_png">
+        <link rel="icon" type="image/png" sizes="16x16" href="$favicon_16x16_png">
+        <link rel="manifest" href="$manifest_json">
+        <link rel="mask-icon" href="$safari_pinned_tab_svg" color="#cf9e5c">
+        <link rel="shortcut icon" href="$favicon_ico">
+        <meta name="msapplication-config" content="$browserconfig_xml">
+        <meta name="theme-color" content="#ffffff">
+        </head><body><div id=header><b>$title</b>$subtitle</div><div id=menu>'''\
+        '''<div class=menu_button><a href=/results>Results</a></div>'''\
+        '''<div class=menu_button><a href=/>Home</a></div></div>''')
+
+FOOTER = '</body></html>'
+
+#Leaderboard (index)
+LEADER_HEAD = '''<h2>Restaurant Leaderboard</h2><br/><table>
+<tr><th>Rank</th><th>Restaurant</th><th>Visits</th><th>Last Visit</th></tr>'''
+LEADER_ROW = Template('<tr><td>$rank</td><td>$name</td><td>$visits</td><td>$last</td></tr>')
+LEADER_TOTALS = Template('</table><h3>Voting events: $events</h3><h3>Total votes cast: $votes</h3>')
+
+LINK = Template('<a href=$href>$text</a>')
+
+#Vote
+VOTE_ROW = Template('''<tr>
+                            <td>$name</td>
+                            <td>$stars</td>
+                        </tr>''')
+VOTE_INSTRUCTIONS = '''<p>Vote below by ranking each of these restaurants with a number of stars,
+                    where &#9733; is "Meh," and &#9733;&#9733;&#9733;&#9733;&#9733; is "I really want to go here!"</p>
+                    <p>Your restaurant choice for this week will be the highest-ranked choice(s) voted for. If you're forced to pick the lesser of two evils, rank them accordingly!</p>
+                    <p>You can give multiple restaurants the same rank if you like them equally.
+                    The rank you give restaurants will affect their future rankings.</p>
+                    <p>If you aren't able to attend this week, please don't vote.</p>'''
+VOTE_FORM = Template('''<form method="post" action="vote">
+<input type="hidden" name="u", value="$u">
+<table class=table_vote>
+<tr><th/>
+                    <th>&#9733;&#9733;&#9733;&#9733;&#9733;</th>
+                    <th>&#9733;&#9733;&#9733;&#9733;</th>
+                    <th>&#9733;&#9733;&#9733;</th>
+                    <th>&#9733;&#9733;</th>
+                    <th>&#9733;</th>
+                    ''')
+VOTE_RADIO = Template('<td><input type="radio" name="c$choice" value="$value" $checked></td>\n')
+VOTE_SUBMIT = '''</table>
+<button type="submit" name="action" value="vote">Vote</button>
+</form>
+'''
+
+#Results
+EVENT_LINK = Template('<p><a href="$href">$date$name</a></p>')
+PAGE_LINK = Template('<p><a href="$href">$text</a></p>')
+RESULTS_ROW = Template('<tr><td>$name</td>$ranks</tr>\n')
+
+#Admin
+ADMIN_START = '''<hr/>Voting:<br/><form method="post", action="admin">No vote is open.
+            Close at<input type="time" name="close">
+            <button type="submit" name="action" value="start_vote">Start Vote</button></form>'''
+ADMIN_END = Template('''<hr/>Voting:<br/><form method="post", action="admin">Voting for $date is open until $close.
+            <button type="submit" name="action" value="end_vote" onclick="return confirm('Close the vote now?');">End Vote</button></form>''')
+ADMIN_RESTAURANT_HEAD = '''<hr/>Restaurants in the list:<br/><table>
+<tr><th/><th>Rank</th><th>Restaurant</th><th>Visits</th><th>Last Visit</th><th>Added</th></tr>'''
+ADMIN_RESTAURANT_ROW = Template('''<tr>
+                <td>
+                    <form style="float:right" method="post" action="admin">
+                        <input type="hidden" name="name" value="$name">
+                        <button type="submit" name="action" value="del_restaurant" onclick="return confirm('Are you sure you want to remove $name?');">X</button>
+                    </form>
+                </td><td>$rank</td><td>$name</td><td>$visits
+                    <form style="float:right" method="post" action="admin">
+                        <input type="hidden" name="name" value="$name">
+                        <button type="submit" name="action" value="increment_visit">+</button>
+                        <button type="submit" name="action" value="decrement_visit">-</button>
+                    </form>
+                    </td><td>$last</td><td>$added</td></tr>''')
+ADMIN_RESTAURANT_FORM = '''</table></br><form method="post", action="admin">
+            Name<input type="text" name="name">
+            Visits<input type="number" name="visits" min="0" value=0>
+            Last Visit<input type="date" name="date">
+            <button class=button type="submit" name="action" value="add_restaurant">Add Restaurant</button>
+            </form>'''
+ADMIN_PEOPLE_HEAD = '''<hr/>People:<br/><table>
+<tr><th/><th>Name</td><th>Email</th><th>Tiebreaks</th></tr>'''
+ADMIN_PEOPLE_ROW = Template('''<tr>
+                <td>
+                    <form style="float:right" method="post" action="admin">
+                        <input type="hidden" name="name" value="$name">
+                        <button type="submit" name="action" value="del_person" onclick="return confirm('Are you sure you want to remove user $name?');">X</button>
+                    </form>
+                </td><td>$name</td><td>$email</td><td>$tb_count</td></tr>''')
+ADMIN_PEOPLE_FORM = '''</table></br><form method="post", action="admin">
+            Name<input type="text" name="name" required>
+            Email<input type="email" name="email">
+            <button type="submit" name="action" value="add_person">Add User</button>
+            </form>'''
+ADMIN_PROFILE = '<hr/><a href="/admin/profile/">Profiler</a>'
+
+#Profiler (under admin)
+PROFILE_REQUESTS = Template('''<hr/>Profile requests:<br/><form method="post" action="/admin/profile/">
+            Profile the next<input type="number" name="count" min="1" max="1000" value="10"> requests to
+            <select name="handler">$options</select>
+            <button type="submit" name="action" value="profile">Start</button></form>''')
+PROFILE_SAMPLE = Template('''<hr/>Sample a thread:<br/><form method="post" action="/admin/profile/">
+            Sample<select name="thread">$options</select>for<input type="number" name="seconds" min="1" max="600" value="30"> seconds
+            <button type="submit" name="action" value="sample">Start</button></form>''')
+PROFILE_MEMORY = '''<hr/>Memory:<br/><form method="post" action="/admin/profile/">
+            Count the objects in memory by type, compared to the last count
+            <button type="submit" name="action" value="memory">Count</button></form>'''
+PROFILE_OPTION = Template('<option value="$value"$selected>$value</option>')
+PROFILE_REPORTS_HEAD = '''<hr/>Reports:<br/><table>
+<tr><th>Report</th><th>Taken</th><th>Count</th><th>Download</th></tr>'''
+PROFILE_REPORT_ROW = Template('<tr><td>$title</td><td>$taken</td><td>$count$running</td><td>$links</td></tr>\n')
+
+_headers = {}     #(title, subtitle, asset versions): header HTML
+_versions = (0, None)     #(time to check again, versions())
+_lock = threading.Lock()
+
+def version(name):
+    '''The version of a static file: its modification time'''
+    try:
+        return int(os.path.getmtime(os.path.join(STATIC_DIR, name)))
+    except OSError:
+        return 0
+
+def asset(name, v=None):
+    '''The versioned URL of a static file'''
+    return "/static/%s?v=%d"%(name, version(name) if v is None else v)
+
+def versions():
+    '''The versions of the files linked from the header; part of every page's
+    ETag. The files are checked at most every VERSIONS_TTL seconds'''
+    global _versions
+    expires, current = _versions
+    now = time.time()
+    if now >= expires:
+        current = tuple(version(name) for name in HEADER_ASSETS)
+        _versions = (now + VERSIONS_TTL, current)
+    return current
+
+def header(title="Lunch Today", subtitle=""):
+    '''Common header HTML, rendered once per title (and again if a linked file changes)'''
+    current = versions()
+    key = (title, subtitle, current)
+    head = _headers.get(key)
+    if head is None:
+        fields = dict((name.replace(".", "_").replace("-", "_"), asset(name, v)) for name, v in zip(HEADER_ASSETS, current))
+        fields.update({"pagetitle": "%s%s"%(title, (": " + subtitle) if subtitle else ""),
+                       "title": title,
+                       "subtitle": (": " + subtitle) if subtitle else ""})
+        head = HEADER.substitute(fields)
+        with _lock:
+            _headers[key] = head
+    return head
+
+def footer():
+    '''Common footer HTML'''
+    return FOOTER
+
+def chunks(pieces, size=16384):
+    '''
+    Joins a stream of small HTML pieces into chunks of about `size`
+    characters, so a streamed page isn't written to the socket a table cell
+    at a time.
+    '''
+    buffered = []
+    length = 0
+    for piece in pieces:
+        buffered.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield "".join(buffered)
+            buffered = []
+            length = 0
+    if buffered:
+        yield "".join(buffered)
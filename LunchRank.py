@@ -0,0 +1,288 @@
+#!/usr/bin/python
+from LunchDB import *
+from LunchDB import Session
+from LunchConfig import LunchConfig
+
+from sqlalchemy import bindparam, and_
+from sqlalchemy.sql.expression import func
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['dirichlet_mean', 'storedHistograms', 'calculateRank',
+           'applyVotes', 'rebuildRatings', 'verifyRatings', 'initRatings',
+           'RankTensor', 'personalRankings', 'verifyRankings']
+
+def dirichlet_mean(votes):
+    """
+    Computes the Dirichlet mean with a prior.
+    Adapted from: http://blog.districtdatalabs.com/computing-a-bayesian-estimate-of-star-rating-means
+    Input is a histogram of vote counts for ranks 1-5
+    Returns a ranking from 0-5
+    """
+    PRIOR = [2,0,0,0,0,0]
+
+    posterior = map(sum, zip(votes, PRIOR))
+    N         = sum(posterior)
+    weights   = map(lambda i: (i[0])*i[1], enumerate(posterior))
+
+    return float(sum(weights)) / N
+
+def storedHistograms(db, user=None):
+    '''Returns a dict of {restaurant id:[count of 1s, 2s, .. 5s]} read from
+    the stored rating tables (see applyVotes).
+    Input a user object to only count that user's votes'''
+
+    model = RestaurantRating if user is None else UserRating
+    rows = db.query(model.restaurant, model.r1, model.r2, model.r3, model.r4, model.r5)
+    if user is not None:
+        rows = rows.filter(UserRating.user==user.id)
+
+    return dict((R[0], list(R[1:])) for R in rows.all())
+
+def calculateRank(db, user=None, update=False):
+    '''Returns a dict of {'rest name':rank} for the entire vote set,
+    OR: input a user object to calculate that user's personal ranking
+    update = TRUE to update the rank entry in a restaurant's db entry'''
+
+    histograms = storedHistograms(db, user)
+
+    rankings = {}
+    updates = []
+    for rest_id, name in db.query(Restaurant.id, Restaurant.name).all():
+        rank = dirichlet_mean(histograms.get(rest_id, [0]*5))
+        rankings[name] = rank
+        updates.append({"rest_id":rest_id, "new_rank":rank})
+
+    if update:
+        #One executemany UPDATE rather than dirtying every Restaurant object
+        if updates:
+            table = Restaurant.__table__
+            db.execute(table.update().where(table.c.id==bindparam("rest_id")).values(rank=bindparam("new_rank")), updates)
+        db.commit()
+
+    return rankings
+
+class RankTensor(object):
+    '''
+    Optional NumPy ranking engine. Loads every user's rating histograms once
+    into a users x restaurants x 5 array of vote counts, then computes the
+    Dirichlet mean for every user and the global ranking in one pass instead
+    of one query per user and restaurant.
+
+    The global histograms are read from RestaurantRating, as calculateRank
+    reads them, rather than summed over the users: they still count the
+    votes of people who have since been deleted.
+    '''
+    def __init__(self, db):
+        if numpy is None:
+            raise ImportError("RankTensor requires numpy")
+
+        self.restaurants = db.query(Restaurant.id, Restaurant.name).order_by(Restaurant.id).all()
+        self.users = [U[0] for U in db.query(User.id).order_by(User.id).all()]
+        rest_index = dict((R[0], i) for i, R in enumerate(self.restaurants))
+        user_index = dict((U, i) for i, U in enumerate(self.users))
+
+        self.counts = numpy.zeros((len(self.users), len(self.restaurants), 5), dtype=numpy.int64)
+        for row in db.query(UserRating.user, UserRating.restaurant,
+                UserRating.r1, UserRating.r2, UserRating.r3, UserRating.r4, UserRating.r5).all():
+            if row[0] in user_index and row[1] in rest_index:
+                self.counts[user_index[row[0]], rest_index[row[1]]] = row[2:]
+
+        self.totals = numpy.zeros((len(self.restaurants), 5), dtype=numpy.int64)
+        for rest, counts in storedHistograms(db).items():
+            if rest in rest_index:
+                self.totals[rest_index[rest]] = counts
+
+    @staticmethod
+    def dirichlet_mean(counts):
+        #Vectorized dirichlet_mean over the last axis of an array of histograms
+        weights = numpy.arange(5)
+        return (counts * weights).sum(axis=-1) / (counts.sum(axis=-1) + 2.0)
+
+    def _named(self, ranks):
+        return dict((R[1], float(rank)) for R, rank in zip(self.restaurants, ranks))
+
+    def globalRank(self):
+        '''Returns a dict of {'rest name':rank}, as calculateRank(db)'''
+        return self._named(self.dirichlet_mean(self.totals))
+
+    def userRanks(self):
+        '''Returns a dict of {user id:{'rest name':rank}}, as calculateRank(db, user) for every user'''
+        ranks = self.dirichlet_mean(self.counts)
+        return dict((U, self._named(ranks[i])) for i, U in enumerate(self.users))
+
+    def rankTables(self):
+        '''Returns a dict of {user id:[(rest name, personal rank, global rank), ...]}
+        with each user's list sorted by their personal ranking'''
+        personal = self.dirichlet_mean(self.counts)
+        overall = self.dirichlet_mean(self.totals)
+        order = numpy.argsort(-personal, axis=1, kind="mergesort")
+
+        tables = {}
+        for i, U in enumerate(self.users):
+            tables[U] = [(self.restaurants[j][1], float(personal[i, j]), float(overall[j])) for j in order[i]]
+        return tables
+
+def personalRankings(db):
+    '''Returns a dict of {user id:{'rest name':rank}} for every user, using
+    the NumPy engine if it is installed'''
+    if numpy is not None:
+        return RankTensor(db).userRanks()
+    return dict((U.id, calculateRank(db, U)) for U in db.query(User).all())
+
+def verifyRankings(db):
+    '''Checks the NumPy engine against calculateRank: the global ranking and
+    every user's personal one. Returns a list of mismatch descriptions
+    (empty if they agree, or if numpy isn't installed)'''
+    if numpy is None:
+        return []
+
+    tensor = RankTensor(db)
+    errors = []
+    expected = calculateRank(db)
+    for name, rank in sorted(tensor.globalRank().items()):
+        if abs(rank - expected[name]) > 1e-9:
+            errors.append("Restaurant %s: RankTensor %f, calculateRank %f"%(name, rank, expected[name]))
+
+    #calculateRank(db, user) for every user, from one query
+    personal = {}
+    for row in db.query(UserRating.user, UserRating.restaurant,
+            UserRating.r1, UserRating.r2, UserRating.r3, UserRating.r4, UserRating.r5).all():
+        personal.setdefault(row[0], {})[row[1]] = list(row[2:])
+    for user, ranks in sorted(tensor.userRanks().items()):
+        histograms = personal.get(user, {})
+        for rest_id, name in tensor.restaurants:
+            rank = dirichlet_mean(histograms.get(rest_id, [0]*5))
+            if abs(ranks[name] - rank) > 1e-9:
+                errors.append("User %d, Restaurant %s: RankTensor %f, calculateRank %f"%(user, name, ranks[name], rank))
+
+    return errors
+
+def _row(keys, counts):
+    row = dict(keys)
+    row.update(("r%d"%(i+1), n) for i, n in enumerate(counts))
+    return row
+
+def _adjust(db, model, keys, counts):
+    #Adds counts to a single histogram row, creating it if it doesn't exist yet
+    table = model.__table__
+    values = dict(("r%d"%(i+1), table.c["r%d"%(i+1)] + n) for i, n in enumerate(counts) if n)
+    if not values:
+        return
+    where = and_(*[table.c[k]==v for k, v in keys.items()])
+    if db.execute(table.update().where(where).values(**values)).rowcount == 0:
+        db.execute(table.insert().values(**_row(keys, counts)))
+
+def applyVotes(db, votes, delta=1):
+    '''
+    Adds (delta=1) or removes (delta=-1) a list of votes from the stored
+    rating histograms. This runs in the caller's transaction, so call it next
+    to the db.add/db.delete of the votes themselves.
+    '''
+    totals = {}
+    personal = {}
+    for vote in votes:
+        if vote.rank not in range(1, 6):
+            continue
+        totals.setdefault(vote.restaurant, [0]*5)[vote.rank-1] += delta
+        if vote.user is not None:
+            personal.setdefault((vote.user, vote.restaurant), [0]*5)[vote.rank-1] += delta
+
+    for rest, counts in totals.items():
+        _adjust(db, RestaurantRating, {"restaurant":rest}, counts)
+    for (user, rest), counts in personal.items():
+        _adjust(db, UserRating, {"user":user, "restaurant":rest}, counts)
+
+def _expectedRatings(db):
+    #Recomputes both sets of histograms from the votes table:
+    #returns ({rest:[..]}, {(user, rest):[..]})
+    totals = {}
+    personal = {}
+    counts = db.query(Vote.user, Vote.restaurant, Vote.rank, func.count(Vote.id)).group_by(Vote.user, Vote.restaurant, Vote.rank)
+    for user, rest, rank, count in counts.all():
+        if rank not in range(1, 6):
+            continue
+        totals.setdefault(rest, [0]*5)[rank-1] += count
+        if user is not None:
+            personal.setdefault((user, rest), [0]*5)[rank-1] += count
+    return totals, personal
+
+def rebuildRatings(db):
+    '''Throws away the stored rating histograms and recomputes them from the votes table'''
+
+    totals, personal = _expectedRatings(db)
+
+    db.query(UserRating).delete()
+    db.query(RestaurantRating).delete()
+    if totals:
+        db.execute(RestaurantRating.__table__.insert(),
+            [_row({"restaurant":rest}, counts) for rest, counts in totals.items()])
+    if personal:
+        db.execute(UserRating.__table__.insert(),
+            [_row({"user":user, "restaurant":rest}, counts) for (user, rest), counts in personal.items()])
+    db.commit()
+
+def verifyRatings(db):
+    '''Compares the stored rating histograms against the votes table.
+    Returns a list of mismatch descriptions (empty if everything agrees)'''
+
+    totals, personal = _expectedRatings(db)
+    errors = []
+
+    stored = dict((R[0], list(R[1:])) for R in db.query(RestaurantRating.restaurant,
+        RestaurantRating.r1, RestaurantRating.r2, RestaurantRating.r3, RestaurantRating.r4, RestaurantRating.r5))
+    for rest in set(totals) | set(stored):
+        if totals.get(rest, [0]*5) != stored.get(rest, [0]*5):
+            errors.append("Restaurant %d: stored %s, votes %s"%(rest, stored.get(rest), totals.get(rest)))
+
+    stored = dict(((R[0], R[1]), list(R[2:])) for R in db.query(UserRating.user, UserRating.restaurant,
+        UserRating.r1, UserRating.r2, UserRating.r3, UserRating.r4, UserRating.r5))
+    for key in set(personal) | set(stored):
+        if personal.get(key, [0]*5) != stored.get(key, [0]*5):
+            errors.append("User %d, Restaurant %d: stored %s, votes %s"%(key[0], key[1], stored.get(key), personal.get(key)))
+
+    return errors
+
+def initRatings(db):
+    '''Builds the rating histograms for a DB created before they existed'''
+    if db.query(RestaurantRating).count() == 0 and db.query(Vote).count() > 0:
+        rebuildRatings(db)
+
+#
+# Run this directly to check or repair the stored rating histograms:
+#   LunchRank.py verify|rebuild [dbfile]
+#
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ["verify", "rebuild"]:
+        print "Usage: %s verify|rebuild [dbfile]"%sys.argv[0]
+        sys.exit(2)
+
+    dbfile = sys.argv[2] if len(sys.argv) > 2 else LunchConfig("lunchconfig.json").dbfile
+    LunchDB(dbfile)
+    db = Session()
+
+    errors = verifyRatings(db)
+    for e in errors:
+        print e
+    print "%d rating histogram(s) out of step with the votes table"%len(errors)
+
+    if sys.argv[1] == "verify" and numpy is not None:
+        mismatches = verifyRankings(db)
+        for e in mismatches:
+            print e
+        print "%d NumPy ranking(s) different from calculateRank"%len(mismatches)
+        errors += mismatches
+
+    if sys.argv[1] == "rebuild":
+        rebuildRatings(db)
+        print "Rebuilt rating histograms from %d votes"%db.query(Vote).count()
+    elif errors:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
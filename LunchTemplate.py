@@ -0,0 +1,44 @@
+#!/usr/bin/python
+from string import Template
+import threading
+import io
+import os, os.path
+
+__all__ = ['LunchTemplate']
+
+class LunchTemplate(object):
+    '''
+    Loads the $macro-style templates (see string.Template) that operators
+    can edit in the templates directory. Each file is compiled once and
+    recompiled when it changes on disk, so edits apply without a restart.
+
+    partial() fills in the fields shared by a batch of emails and returns a
+    Template of what's left, so only per-recipient fields (like $link) are
+    substituted for each message.
+    '''
+    def __init__(self, path="templates"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.cache = {}     #name: (mtime, Template)
+
+    def get(self, name):
+        '''Returns the compiled Template for a file in the templates directory'''
+        filename = os.path.join(self.path, name)
+        mtime = os.path.getmtime(filename)
+        cached = self.cache.get(name)
+        if cached is None or cached[0] != mtime:
+            with io.open(filename, encoding="utf-8") as F:
+                cached = (mtime, Template(F.read()))
+            with self.lock:
+                self.cache[name] = cached
+        return cached[1]
+
+    def render(self, template, **fields):
+        '''Renders a template; fields that aren't given are left as $macros'''
+        return self.get(template).safe_substitute(fields)
+
+    def partial(self, template, **fields):
+        '''Renders the given fields and returns a Template for the rest'''
+        #Escape any $ in the values so they survive the second substitution
+        fields = dict((K, unicode(V).replace(u"$", u"$$")) for K, V in fields.items())
+        return Template(self.get(template).safe_substitute(fields))
@@ -0,0 +1,355 @@
+#!/usr/bin/python
+from LunchDB import *
+from LunchDB import Session
+from LunchConfig import LunchConfig
+
+import itertools
+import random
+import threading
+import sys
+import json
+from copy import copy
+from time import time
+from datetime import date
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['SchulzeTally', 'schulze', 'pairwiseCounts', 'widestPaths', 'eventTally',
+           'encodeResults', 'decodeResults', 'storeResults', 'loadResults']
+
+def pairwiseCounts(candidates, ballots):
+    '''
+    Counts the pairwise preferences of a list of {candidate:rating} ballots.
+    Returns a dict of {(a, b): number of ballots rating a above b}. Candidates
+    missing from a ballot rank below everything on it.
+    '''
+    candidates = list(candidates)
+    if numpy is None:
+        return SchulzeTally(dict(enumerate(ballots)), candidates).pairs
+
+    ratings = numpy.empty((len(ballots), len(candidates)))
+    for row, ballot in enumerate(ballots):
+        lowest = min(ballot.values()) - 1
+        ratings[row] = [ballot.get(C, lowest) for C in candidates]
+
+    #Compare in chunks to bound the ballots x candidates x candidates temporary
+    counts = numpy.zeros((len(candidates), len(candidates)), dtype=numpy.int64)
+    for start in range(0, len(ballots), 256):
+        chunk = ratings[start:start+256]
+        counts += (chunk[:, :, None] > chunk[:, None, :]).sum(axis=0)
+
+    return dict(((a, b), int(counts[i, j])) for (i, a), (j, b)
+                in itertools.permutations(enumerate(candidates), 2))
+
+def widestPaths(candidates, strong_pairs):
+    '''Strongest-path (widest path) strengths between every pair of candidates,
+    computed over the pairwise defeats'''
+    candidates = list(candidates)
+    if numpy is None:
+        paths = dict((P, strong_pairs.get(P, 0)) for P in itertools.permutations(candidates, 2))
+        for k in candidates:
+            for i in candidates:
+                for j in candidates:
+                    if i != j and k != i and k != j:
+                        paths[(i, j)] = max(paths[(i, j)], min(paths[(i, k)], paths[(k, j)]))
+        return paths
+
+    n = len(candidates)
+    P = numpy.zeros((n, n), dtype=numpy.int64)
+    for (i, a), (j, b) in itertools.permutations(enumerate(candidates), 2):
+        P[i, j] = strong_pairs.get((a, b), 0)
+    for k in range(n):
+        P = numpy.maximum(P, numpy.minimum(P[:, k, None], P[None, k, :]))
+
+    return dict(((a, b), P[i, j].item()) for (i, a), (j, b)
+                in itertools.permutations(enumerate(candidates), 2))
+
+def _results(candidates, pairs, tie_breaker=None):
+    #Schulze winner(s) from a pairwise count, in SchulzeMethod.as_dict() form
+    strong = dict((P, W) for P, W in pairs.items() if W > pairs[(P[1], P[0])])
+    paths = widestPaths(candidates, strong)
+
+    #As in pyvotecore, candidates nobody beats outright win before any
+    #beatpaths are considered (even if a separate cycle is also unbeaten)
+    winners = set(candidates) - set(P[1] for P in strong)
+    if not winners:
+        winners = set(C for C in candidates
+            if all(paths[(C, O)] >= paths[(O, C)] for O in candidates if O != C))
+
+    output = {"candidates":set(candidates), "pairs":pairs, "strong_pairs":strong, "strong_paths":paths}
+    if len(winners) == 1:
+        output["winner"] = list(winners)[0]
+    else:
+        if tie_breaker is None:
+            tie_breaker = list(candidates)
+            random.shuffle(tie_breaker)
+        output["tied_winners"] = winners
+        output["tie_breaker"] = list(tie_breaker)
+        output["winner"] = ([C for C in tie_breaker if C in winners] + [None])[0]
+    return output
+
+def schulze(ballots, tie_breaker=None, backend="native"):
+    '''
+    Runs a Schulze count over a list of {candidate:rating} ballots.
+    backend="native" uses the built-in (vectorized, if numpy is installed)
+    solver; backend="pyvotecore" runs the reference SchulzeMethod.
+    Returns a SchulzeMethod.as_dict() style dict, or None with no ballots.
+    '''
+    if not ballots:
+        return None
+
+    if backend == "pyvotecore":
+        from pyvotecore.schulze_method import SchulzeMethod
+        input = [{"count":1, "ballot":copy(B)} for B in ballots]
+        return SchulzeMethod(input, tie_breaker=tie_breaker, ballot_notation="rating").as_dict()
+
+    candidates = set()
+    for B in ballots:
+        candidates |= set(B)
+    return _results(candidates, pairwiseCounts(candidates, ballots), tie_breaker)
+
+class SchulzeTally(object):
+    '''
+    Incremental Schulze count for a single event.
+
+    Keeps the pairwise preference matrix up to date as ballots are added or
+    replaced, so results only need a strongest-path pass over the (tiny)
+    candidate matrix rather than re-reading every ballot.
+
+    Ballots are dicts of {candidate:rating}, higher ratings preferred, the
+    same as pyvotecore's ballot_notation="rating". results() returns the same
+    winner, tied_winners, tie_breaker, candidates, pairs and strong_pairs
+    entries as SchulzeMethod(...).as_dict(), plus the strong_paths matrix.
+    '''
+    def __init__(self, ballots=None, candidates=None):
+        self.lock = threading.RLock()
+        self.ballots = {}
+        self.candidates = set()
+        self.pairs = {}
+        if candidates:
+            self.candidates = set(candidates)
+            self._rebuild()
+        for voter, ballot in (ballots or {}).items():
+            self.add(voter, ballot)
+
+    def __len__(self):
+        return len(self.ballots)
+
+    def _complete(self, ballot):
+        #Candidates missing from a ballot rank below everything on it
+        lowest = min(ballot.values()) - 1
+        return dict((C, float(ballot.get(C, lowest))) for C in self.candidates)
+
+    def _count(self, ballot, delta):
+        ballot = self._complete(ballot)
+        for a, b in itertools.permutations(self.candidates, 2):
+            if ballot[a] > ballot[b]:
+                self.pairs[(a, b)] += delta
+
+    def _rebuild(self):
+        self.pairs = dict((P, 0) for P in itertools.permutations(self.candidates, 2))
+        for ballot in self.ballots.values():
+            self._count(ballot, 1)
+
+    def add(self, voter, ballot):
+        '''Adds a voter's ballot, replacing any ballot they already cast'''
+        if not ballot:
+            return self.remove(voter)
+        with self.lock:
+            if voter in self.ballots:
+                self._count(self.ballots.pop(voter), -1)
+            self.ballots[voter] = dict(ballot)
+            if not set(ballot) <= self.candidates:
+                #A new candidate changes how every other ballot is completed
+                self.candidates |= set(ballot)
+                self._rebuild()
+            else:
+                self._count(ballot, 1)
+
+    def remove(self, voter):
+        with self.lock:
+            if voter in self.ballots:
+                self._count(self.ballots.pop(voter), -1)
+
+    def results(self, tie_breaker=None):
+        '''
+        Returns the Schulze results as a dict, or None if there are no ballots.
+        tie_breaker is an ordered list of candidates to pick from when tied;
+        like pyvotecore a random order is used when none is given.
+        '''
+        with self.lock:
+            if not self.ballots:
+                return None
+            candidates = set(self.candidates)
+            pairs = dict(self.pairs)
+
+        return _results(candidates, pairs, tie_breaker)
+
+def eventTally(db, event):
+    '''Builds a SchulzeTally from all of the votes for an event'''
+    votes = {}
+    for user, rank, rest in db.query(Vote.user, Vote.rank, Restaurant.name).join(Restaurant).filter(Vote.event==event.id).all():
+        votes.setdefault(user, {})[rest] = rank
+    return SchulzeTally(votes)
+
+def _triples(pairs):
+    return sorted([a, b, w] for (a, b), w in pairs.items())
+
+def encodeResults(results):
+    '''Serializes a schulze() results dict (or None) to JSON'''
+    if results is None:
+        return json.dumps(None)
+    data = {"candidates":sorted(results["candidates"]),
+            "pairs":_triples(results["pairs"]),
+            "strong_pairs":_triples(results["strong_pairs"]),
+            "strong_paths":_triples(results["strong_paths"]),
+            "winner":results["winner"]}
+    if "tied_winners" in results:
+        data["tied_winners"] = sorted(results["tied_winners"])
+    if "tie_breaker" in results:
+        data["tie_breaker"] = list(results["tie_breaker"])
+    return json.dumps(data)
+
+def decodeResults(text):
+    '''The inverse of encodeResults'''
+    data = json.loads(text)
+    if data is None:
+        return None
+    results = {"candidates":set(data["candidates"]), "winner":data["winner"]}
+    for key in ["pairs", "strong_pairs", "strong_paths"]:
+        results[key] = dict(((a, b), w) for a, b, w in data[key])
+    if "tied_winners" in data:
+        results["tied_winners"] = set(data["tied_winners"])
+    if "tie_breaker" in data:
+        results["tie_breaker"] = data["tie_breaker"]
+    return results
+
+def storeResults(db, event, results):
+    '''Records the final results of a closed event (in the caller's transaction)'''
+    db.merge(EventResult(event=event.id, winner=results["winner"] if results else None, data=encodeResults(results)))
+
+def loadResults(db, event):
+    '''Returns (True, results) if results are stored for this event, else (False, None)'''
+    row = db.query(EventResult).get(event.id)
+    if row is None:
+        return False, None
+    return True, decodeResults(row.data)
+
+def _recompute(db, event):
+    #Results of a closed event from its votes, with the winner it was given
+    results = eventTally(db, event).results()
+    if results is not None and "tied_winners" in results:
+        #The original tie-breaker order wasn't recorded
+        del results["tie_breaker"]
+        if event.winner is not None:
+            results["winner"] = event.winner.name
+    return results
+
+def _compareResults(stored, fresh):
+    #Returns the first key where stored and recomputed results disagree, or None
+    if stored is None or fresh is None:
+        return None if stored == fresh else "votes"
+    for key in ["candidates", "pairs", "strong_pairs", "strong_paths", "tied_winners"]:
+        if stored.get(key) != fresh.get(key):
+            return key
+    if "tied_winners" not in stored and stored["winner"] != fresh["winner"]:
+        return "winner"
+    return None
+
+def backfillResults(db):
+    '''Stores results for every past event that doesn't have them yet.
+    Events from today that have no winner may still be open, so are skipped'''
+    count = 0
+    stored = set(R[0] for R in db.query(EventResult.event).all())
+    for event in db.query(Event).order_by(Event.id).all():
+        if event.id in stored or (event.winner is None and event.date >= date.today()):
+            continue
+        storeResults(db, event, _recompute(db, event))
+        count += 1
+    db.commit()
+    return count
+
+def verifyResults(db):
+    '''Recomputes the results of every event with stored results.
+    Returns a list of mismatch descriptions (empty if everything agrees)'''
+    errors = []
+    for event, row in db.query(Event, EventResult).join(EventResult, EventResult.event==Event.id).order_by(Event.id).all():
+        key = _compareResults(decodeResults(row.data), _recompute(db, event))
+        if key is not None:
+            errors.append("Event %d (%s): stored %s differs from the votes"%(event.id, event.date, key))
+    return errors
+
+#
+# Run this directly to maintain the stored event results, or to check the
+# native solver against pyvotecore:
+#   LunchVote.py backfill|verify [dbfile]
+#   LunchVote.py check [trials]
+#
+
+def _compare(ballots, tie_breaker):
+    #Returns the first key where the two backends disagree, or None
+    ref = schulze(ballots, tie_breaker, backend="pyvotecore")
+    out = schulze(ballots, tie_breaker)
+    for key in ["candidates", "pairs", "strong_pairs", "winner", "tied_winners", "tie_breaker"]:
+        if ref.get(key) != out.get(key):
+            return key
+    return None
+
+def check(trials):
+    failures = 0
+
+    for trial in range(trials):
+        #Mostly small lunch-sized ballots, with the odd large one; a coarse
+        #rating scale makes ties common enough to exercise the tie-breaker
+        size = random.choice([2, 3, 5, 5, 5, 8, 12, 20, 50])
+        voters = random.choice([1, 2, 5, 10, 25, 100])
+        scale = random.choice([2, 3, 5])
+        candidates = ["R%d"%i for i in range(size)]
+        ballots = [dict((C, random.randint(1, scale)) for C in candidates) for _ in range(voters)]
+        tie_breaker = random.sample(candidates, size)
+
+        key = _compare(ballots, tie_breaker)
+        if key is not None:
+            failures += 1
+            print "Trial %d (%d candidates, %d ballots): backends disagree on %s"%(trial, size, voters, key)
+
+    print "%d/%d trials matched pyvotecore"%(trials-failures, trials)
+
+    #Rough timing of a large election
+    candidates = ["R%d"%i for i in range(50)]
+    ballots = [dict((C, random.randint(1, 5)) for C in candidates) for _ in range(5000)]
+    start = time()
+    schulze(ballots)
+    print "Native: 50 candidates, 5000 ballots in %.3fs"%(time()-start)
+
+    return failures
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ["backfill", "verify", "check"]:
+        print "Usage: %s backfill|verify [dbfile]"%sys.argv[0]
+        print "       %s check [trials]"%sys.argv[0]
+        sys.exit(2)
+
+    if sys.argv[1] == "check":
+        failures = check(int(sys.argv[2]) if len(sys.argv) > 2 else 500)
+        sys.exit(1 if failures else 0)
+
+    dbfile = sys.argv[2] if len(sys.argv) > 2 else LunchConfig("lunchconfig.json").dbfile
+    LunchDB(dbfile)
+    db = Session()
+
+    if sys.argv[1] == "backfill":
+        print "Stored results for %d event(s)"%backfillResults(db)
+    else:
+        errors = verifyResults(db)
+        for e in errors:
+            print e
+        print "%d stored event result(s) out of step with the votes table"%len(errors)
+        if errors:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from cherrypy.process import plugins
+
+__all__ = ['ConfigPlugin']
+
+#Settings that are only read at startup: a change is logged, and applies after a restart
+RESTART = {
+    "lunch": ["dbfile", "templates"],
+    "server": ["host", "port", "reuse_port"],
+    "cluster": ["poll"],
+    "database": ["pool_size", "max_overflow"],
+    "smtp": ["workers"],
+}
+
+class ConfigPlugin(plugins.Monitor):
+    def __init__(self, bus, cfg, frequency=5):
+        """
+        This plugin checks the config file (a LunchConfig) every `frequency`
+        seconds and reloads it when it changes. The new settings are swapped
+        in whole, then 'config-changed' is published with the settings and
+        the keys that changed, as {section: [keys]}, for the plugins that
+        hold on to them: the Manager (schedule and lease), the mail queue
+        (smtp) and the DB engine (sqlite pragmas).
+
+        Anything else reads the settings as it needs them and sees the new
+        ones straight away, except the RESTART settings.
+
+        A file that can't be read or doesn't check out is logged and
+        ignored, and the server carries on with the settings it has until
+        the file is fixed.
+        """
+        plugins.Monitor.__init__(self, bus, self.check, frequency, name="ConfigMonitor")
+        self.cfg = cfg
+
+    def check(self):
+        try:
+            changed = self.cfg.reload()
+        except ValueError, e:
+            self.bus.log("Ignoring %s until it's fixed: %s"%(self.cfg.cfgfile, e), level=30)
+            return
+        except Exception:
+            self.bus.log("Error reloading %s"%self.cfg.cfgfile, level=40, traceback=True)
+            return
+        if not changed:
+            return
+
+        self.bus.log("Reloaded %s: %s"%(self.cfg.cfgfile, ", ".join(
+            "%s.%s"%(section, key) for section, keys in sorted(changed.items()) for key in keys)))
+        restart = ["%s.%s"%(section, key) for section, keys in sorted(changed.items())
+                   for key in keys if key in RESTART.get(section, [])]
+        if restart:
+            self.bus.log("Restart to apply %s"%", ".join(restart), level=30)
+        try:
+            self.bus.publish("config-changed", self.cfg.settings, changed)
+        except Exception:
+            #A listener failed; the others have applied the new settings
+            self.bus.log("Error applying the new settings", level=40, traceback=True)
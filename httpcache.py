@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import os, os.path
+import sys
+import gzip as gziplib
+import mimetypes
+import urllib
+from hashlib import md5
+
+import cherrypy
+from cherrypy.lib import static, encoding, cptools, set_vary_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__all__ = ['etag', 'validate', 'compress', 'assets', 'precompress']
+
+#Content-Encoding: suffix of the precompressed copy of a static file, best first
+PRECOMPRESSED = [('br', '.br'), ('gzip', '.gz')]
+
+COMPRESSIBLE = ['text/html', 'text/plain', 'text/css', 'text/xml', 'application/javascript',
+                'application/json', 'application/xml', 'image/svg+xml', 'image/x-icon']
+
+#Static files named with their ?v= version never change; other ones may
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, max-age=86400'
+
+def etag(*version):
+    '''
+    A weak ETag for a page built from data at the given version (any
+    values with a stable repr). It is weak because the page is the same
+    whether or not it's compressed on the way out.
+    '''
+    return 'W/"%s"'%md5(repr(version)).hexdigest()
+
+def validate(tag):
+    '''
+    Sets the page's ETag and answers 304 Not Modified (by raising) if the
+    client already has it. Call it before building the page, so a
+    revalidation costs only the queries that produced the tag.
+    '''
+    response = cherrypy.serving.response
+    response.headers['ETag'] = tag
+    response.headers['Cache-Control'] = 'no-cache'
+    cptools.validate_etags()
+
+def accepted(codings):
+    '''The codings the client accepts from the given list, best first'''
+    qvalues = dict((E.value, E.qvalue) for E in cherrypy.serving.request.headers.elements('Accept-Encoding'))
+    ranked = [(qvalues.get(C, qvalues.get('*', 0)), -i, C) for i, C in enumerate(codings)]
+    return [C for q, i, C in sorted(ranked, reverse=True) if q > 0]
+
+def compress(compress_level=5, mime_types=COMPRESSIBLE, debug=False):
+    '''
+    tools.gzip, answering with brotli instead when it's installed and the
+    client prefers it. Streamed pages (see Lunch.stream) are always gzipped,
+    since gzip compresses them chunk by chunk.
+    '''
+    request = cherrypy.serving.request
+    response = cherrypy.serving.response
+    ctype = response.headers.get('Content-Type', '').split(';')[0]
+    if (brotli is not None and not response.stream and response.body and ctype in mime_types
+            and not getattr(request, 'cached', False) and accepted(['br', 'gzip'])[:1] == ['br']):
+        set_vary_header(response, 'Accept-Encoding')
+        response.body = brotli.compress(response.collapse_body())
+        response.headers['Content-Encoding'] = 'br'
+        response.headers.pop('Content-Length', None)
+        return
+    encoding.gzip(compress_level, mime_types, debug)
+
+def assets(section, dir, **kwargs):
+    '''
+    tools.staticdir, but it serves file.br or file.gz in place of file when
+    the client accepts it and the copy is up to date (see precompress), and
+    marks the response cacheable: for a year when the URL carries a ?v=
+    version, otherwise for a day.
+    '''
+    request = cherrypy.serving.request
+    response = cherrypy.serving.response
+    if request.method not in ('GET', 'HEAD'):
+        return False
+
+    response.headers['Cache-Control'] = IMMUTABLE if 'v' in request.params else REVALIDATE
+    set_vary_header(response, 'Accept-Encoding')
+    try:
+        if serveCompressed(section, dir) or static.staticdir(section, dir, **kwargs):
+            return True
+    except cherrypy.HTTPError:
+        #Don't let anything cache a 403 or 404
+        response.headers.pop('Cache-Control', None)
+        raise
+    response.headers.pop('Cache-Control', None)
+    return False
+
+def serveCompressed(section, dir):
+    #Serves the best up-to-date precompressed copy of the requested file, if there is one
+    request = cherrypy.serving.request
+    response = cherrypy.serving.response
+    branch = urllib.unquote(request.path_info[len(section.rstrip('/')) + 1:].lstrip('/'))
+    filename = os.path.normpath(os.path.join(dir, branch))
+    if not (filename.startswith(os.path.join(dir, '')) and os.path.isfile(filename)):
+        return False
+    for coding in accepted([C for C, suffix in PRECOMPRESSED]):
+        variant = filename + dict(PRECOMPRESSED)[coding]
+        if os.path.isfile(variant) and os.path.getmtime(variant) >= os.path.getmtime(filename):
+            static.serve_file(variant, content_type=mimetypes.guess_type(filename)[0])
+            response.headers['Content-Encoding'] = coding
+            #Already compressed: this keeps tools.gzip from compressing it again
+            request.cached = True
+            return True
+    return False
+
+def precompress(path="static"):
+    '''
+    Writes a .gz copy (and a .br copy, if brotli is installed) of each
+    compressible file in the static directory, for assets() to serve.
+    '''
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            filename = os.path.join(root, name)
+            if filename.endswith(tuple(suffix for C, suffix in PRECOMPRESSED)):
+                continue
+            if mimetypes.guess_type(filename)[0] not in COMPRESSIBLE:
+                continue
+            with open(filename, 'rb') as F:
+                data = F.read()
+            with open(filename + '.gz', 'wb') as F:
+                Z = gziplib.GzipFile('', 'wb', 9, F, 0)
+                Z.write(data)
+                Z.close()
+            written = ['gz']
+            if brotli is not None:
+                with open(filename + '.br', 'wb') as F:
+                    F.write(brotli.compress(data))
+                written.append('br')
+            print filename, ", ".join(written)
+
+if __name__ == '__main__':
+    precompress(sys.argv[1] if len(sys.argv) > 1 else "static")
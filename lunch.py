@@ -1,23 +1,37 @@
 #!/usr/bin/python
 from LunchDB import *
+from LunchDB import Session
 from LunchConfig import LunchConfig
-from LunchMail import LunchMail
+from LunchRank import calculateRank, initRatings
+from LunchVote import eventTally, storeResults, loadResults
+from LunchTemplate import LunchTemplate
+import LunchPage as page
 
 import cherrypy
-from cherrypy.process.plugins import Monitor
+from cherrypy.process.plugins import SimplePlugin
 from saplugin import SAEnginePlugin
+from mailqueue import MailQueuePlugin, queueMail
+from voteplugin import VoteWriterPlugin
 from satool import SATool
+from metricsplugin import MetricsPlugin
+from metricstool import MetricsTool
+from profilerplugin import ProfilerPlugin
+from configplugin import ConfigPlugin
+import httpcache
 
-from sqlalchemy import cast, Date
+from sqlalchemy import func, or_, and_
+from sqlalchemy.exc import IntegrityError
 
-from pyvotecore.schulze_method import SchulzeMethod
 
-from datetime import datetime, date, time, timedelta
-from time import sleep
+from datetime import datetime, date, timedelta
 import random
 import os
-from copy import copy
-from collections import Counter
+import socket
+import uuid
+import urllib
+import cgi
+from collections import namedtuple
+import threading
 
 ### DEBUG
 DEBUG = False
@@ -26,63 +40,18 @@ DEBUG = False
 # Load global configuration options
 cfg = LunchConfig("lunchconfig.json")
 
-def dirichlet_mean(arr):
-    """
-    Computes the Dirichlet mean with a prior.
-    Adapted from: http://blog.districtdatalabs.com/computing-a-bayesian-estimate-of-star-rating-means
-    Returns a ranking from 0-5
-    """
-    PRIOR = [2,0,0,0,0,0]
-
-    counter   = Counter(arr)
-    votes     = [counter.get(n, 0) for n in range(1, 6)]
-    posterior = map(sum, zip(votes, PRIOR))
-    N         = sum(posterior)
-    weights   = map(lambda i: (i[0])*i[1], enumerate(posterior))
-
-    return float(sum(weights)) / N
-
-def calculateRank(db, user=None, update=False):
-    '''Returns a dict of {'rest name':rank} for the entire vote set,
-    OR: input a user object to calculate that user's personal ranking
-    update = TRUE to update the rank entry in a restaurant's db entry'''
-
-    rankings = {}
-    for rest in db.query(Restaurant).all():
-        ranks = db.query(Vote.rank).join(Restaurant).filter(Restaurant.name==rest.name)
-        if user is not None:
-            ranks = ranks.filter(Vote.user==user.id)
-        ranks = [r[0] for r in ranks.all()] #db returns single results in a tuple for some reason
-        
-        rank = dirichlet_mean(ranks)
-        rankings[rest.name] = rank
-        if update:
-            rest.rank = rank
-
-    if update:
-        db.commit()
-
-    return rankings   
+# Email (and page) templates
+templates = LunchTemplate(cfg.templates)
 
-def calculateVote(db, event, break_ties=False):
-    '''Calculate the winner for this event based on current votes'''
+def calculateVote(db, event, break_ties=False, tally=None):
+    '''Calculate the winner for this event based on current votes.
+    Pass in the live tally for the open event to skip re-reading its ballots'''
 
-    #return a dict of all votes for all users for a single event
-    votes = {}
-    event_votes = db.query(User.name, Vote.rank, Restaurant.name).join(Vote).join(Restaurant).filter(Vote.event==event.id)
+    if tally is None:
+        tally = eventTally(db, event)
 
-    if event_votes.count() > 0:
-        for user, rank, rest in event_votes.all():
-            entry = votes.get(user, {})
-            entry[rest] = rank
-            votes[user] = entry
-    
-        #Format the list into the input for Schulze
-        input = []
-        for v in votes:
-            input.append({"count":1, "ballot":copy(votes[v])})
-
-        output = SchulzeMethod(input, ballot_notation="rating").as_dict()
+    if len(tally) > 0:
+        output = tally.results()
         tb_user = None
 
         if "tied_winners" in output and break_ties:            
@@ -91,14 +60,14 @@ def calculateVote(db, event, break_ties=False):
             users = [U for U in users if U.tb_count == users[0].tb_count]
             tb_user = random.choice(users)
 
-            tb_votes = event_votes.filter(Vote.user == tb_user.id).order_by(Vote.rank.desc()).all()
-            tb_list = [x[2] for x in tb_votes]        
+            tb_votes = db.query(Restaurant.name).join(Vote).filter(Vote.event==event.id, Vote.user==tb_user.id).order_by(Vote.rank.desc()).all()
+            tb_list = [x[0] for x in tb_votes]        
 
             #Update the user's tb_count
             tb_user.tb_count += 1
             db.commit()
 
-            output = SchulzeMethod(input, tie_breaker=tb_list, ballot_notation="rating").as_dict()
+            output = tally.results(tie_breaker=tb_list)
 
         return output, tb_user
 
@@ -106,106 +75,417 @@ def calculateVote(db, event, break_ties=False):
         #No votes?!
         return None, ""    
 
-class Manager(Monitor):
-    ''' 
-    This CherryPy plugin manages creation and operation of vote sessions.
-    Is is set up to be run twice a minute, and operates based on the 
-    current time and day, and values of LunchConfig
+def eventResults(db, event, tally=None):
+    '''Results to display for an event: from the live tally while it is open,
+    otherwise the results stored when it closed'''
+    if tally is None:
+        stored, results = loadResults(db, event)
+        if stored:
+            return results
+    results, _ = calculateVote(db, event, tally=tally)
+    return results
+
+def eventHistory(db, before=None, count=10):
+    '''
+    One page of the event list, newest first: (id, date, winner name) for
+    the `count` events after event id `before` (or the newest ones), and
+    whether there are any older ones. The page is found with the
+    ix_events_date_id index rather than by skipping rows, so any page
+    costs the same however long the history is.
+    '''
+    query = db.query(Event.id, Event.date, Restaurant.name).outerjoin(Restaurant, Restaurant.id==Event.winner_id)
+    if before is not None:
+        key = db.query(Event.date, Event.id).filter(Event.id==before).one_or_none()
+        if key is not None:
+            query = query.filter(Event.date<=key.date, or_(Event.date<key.date, Event.id<key.id))
+    rows = query.order_by(Event.date.desc(), Event.id.desc()).limit(count+1).all()
+    return rows[:count], len(rows) > count
+
+def voteMatrix(db, event):
+    '''
+    The votes for an event from one query: the choices' restaurant names in
+    ballot order, and a sorted list of (voter name, [rank of each choice])
+    with -1 for a choice the voter didn't rank.
     '''
-    def __init__(self, bus, interval):
-        super(Manager, self).__init__(bus, self.run, interval)
+    rows = db.query(Choice.num, Restaurant.name, Vote.user, User.name, Vote.rank).join(
+        Restaurant, Restaurant.id==Choice.restaurant).outerjoin(
+        Vote, and_(Vote.event==Choice.event, Vote.restaurant==Choice.restaurant)).outerjoin(
+        User, User.id==Vote.user).filter(Choice.event==event.id).order_by(Choice.num).all()
+
+    columns = {}
+    names = []
+    votes = {}      #user id: (name, ranks)
+    for num, restaurant, userid, username, rank in rows:
+        if num not in columns:
+            columns[num] = len(names)
+            names.append(restaurant)
+        if username is not None:
+            votes.setdefault(userid, (username, {}))[1][columns[num]] = rank
+    return names, sorted((name, [ranks.get(i, -1) for i in range(len(names))]) for name, ranks in votes.values())
+
+EventChoice = namedtuple("EventChoice", ["num", "restaurant", "name", "website"])
+EventSnapshot = namedtuple("EventSnapshot", ["id", "date", "close", "choices"])
+
+def eventSnapshot(db, event, close):
+    '''Builds an immutable EventSnapshot of an open event and its choices, in ballot order'''
+    choices = db.query(Choice.num, Restaurant.id, Restaurant.name, Restaurant.website).join(
+        Restaurant, Restaurant.id==Choice.restaurant).filter(Choice.event==event.id).order_by(Choice.num).all()
+    return EventSnapshot(event.id, event.date, close, tuple(EventChoice(*C) for C in choices))
+
+class OpenEvent(SimplePlugin):
+    '''
+    This CherryPy plugin tells the web pages which event is open. It reads
+    it from the event_windows table rather than asking the Manager, so any
+    number of lunch.py processes can serve votes while only one of them runs
+    the schedule. The open event is re-read at most every `poll` seconds,
+    or straight away after an "event-changed".
+
+    It also keeps an EventSnapshot of the open event and its live
+    SchulzeTally. Ballots committed by this process are added to the tally
+    as they land. EventWindow.ballots counts the ballots written by every
+    process; when other processes have written some, the tally is re-read
+    from the votes table.
+    '''
+    def __init__(self, bus, poll=5):
+        super(OpenEvent, self).__init__(bus)
+        self.poll = timedelta(seconds=poll)
+        self.lock = threading.RLock()
+        self.checked = None     #When the open event was last read
         self.eventid = None
-
-        #init the DB
-        LunchDB(cfg.dbfile)     
-
-        #init the mailer
-        self.mail = LunchMail(cfg.smtp["server"], cfg.smtp["port"], cfg.smtp["user"], cfg.smtp["pass"])
+        self.closes = None
+        self.ballots = 0        #EventWindow.ballots when it was last read
+        self.snapshot = None
+        self.tally = None
+        self.tallied = None     #The EventWindow.ballots count the tally includes
 
     def start(self):
         self.bus.subscribe("get-event", self.getEvent)        
-        super(Manager, self).start()
+        self.bus.subscribe("get-snapshot", self.getSnapshot)
+        self.bus.subscribe("get-tally", self.getTally)
+        self.bus.subscribe("tally-vote", self.tallyVote)
+        self.bus.subscribe("tally-synced", self.tallySynced)
+        self.bus.subscribe("reset-tally", self.resetTally)
+        self.bus.subscribe("event-changed", self.changed)
 
     def stop(self):
         self.bus.unsubscribe("get-event", self.getEvent)        
-        super(Manager, self).stop()
+        self.bus.unsubscribe("get-snapshot", self.getSnapshot)
+        self.bus.unsubscribe("get-tally", self.getTally)
+        self.bus.unsubscribe("tally-vote", self.tallyVote)
+        self.bus.unsubscribe("tally-synced", self.tallySynced)
+        self.bus.unsubscribe("reset-tally", self.resetTally)
+        self.bus.unsubscribe("event-changed", self.changed)
+
+    def refresh(self, force=False):
+        #Re-reads the open event if it hasn't been checked in the last `poll` seconds
+        now = datetime.now()
+        if not force and self.checked is not None and now - self.checked < self.poll:
+            return
+        db = self.bus.publish("bind-session")[0]
+        row = db.query(EventWindow.event, EventWindow.closes, EventWindow.ballots).filter(
+            EventWindow.closed==False).order_by(EventWindow.opens.desc()).first()
+        with self.lock:
+            if row is None:
+                self.eventid = self.closes = self.snapshot = self.tally = None
+            else:
+                if (row.event, row.closes) != (self.eventid, self.closes):
+                    self.snapshot = None
+                if row.event != self.eventid:
+                    self.tally = None
+                self.eventid, self.closes, self.ballots = row
+            self.checked = now
 
-    def getEventId(self):
-        return self.eventid
+    def changed(self):
+        #The open event was started, ended or changed by this process
+        self.checked = None
 
     def getEvent(self):
-        if self.eventid is not None:
-            db = self.bus.publish("bind-session")[0]
-            return db.query(Event).filter_by(id=self.eventid).one_or_none()        
-        else:
+        self.refresh()
+        if self.eventid is None:
             return None
+        db = self.bus.publish("bind-session")[0]
+        return db.query(Event).filter_by(id=self.eventid).one_or_none()        
+
+    def getSnapshot(self):
+        '''Returns the EventSnapshot of the open event, or None if voting is closed'''
+        self.refresh()
+        with self.lock:
+            if self.snapshot is None and self.eventid is not None:
+                self.snapshot = eventSnapshot(self.bus.publish("bind-session")[0], self.getEvent(), self.closes)
+            return self.snapshot
+
+    def getTally(self, eventid, fresh=False):
+        '''Returns the live SchulzeTally if eventid is the open event, else None.
+        Pass fresh=True to check for other processes' ballots first'''
+        self.refresh(fresh)
+        with self.lock:
+            if eventid is None or eventid != self.eventid:
+                return None
+            if self.tally is None or self.tallied != self.ballots:
+                db = self.bus.publish("bind-session")[0]
+                self.tallied = db.query(EventWindow.ballots).filter(EventWindow.event==eventid).scalar()
+                self.ballots = max(self.ballots, self.tallied)
+                self.tally = eventTally(db, self.getEvent())
+            return self.tally
+
+    def tallyVote(self, eventid, userid, ballot):
+        #Called with a {'rest name':rank} ballot once a vote is committed
+        with self.lock:
+            if self.tally is not None and eventid == self.eventid:
+                self.tally.add(userid, ballot)
+
+    def tallySynced(self, eventid, before, after):
+        #The vote writer took EventWindow.ballots from before to after. If the
+        #tally was up to date, it still is; if not, it is re-read when next needed
+        with self.lock:
+            if eventid == self.eventid:
+                if self.tallied == before:
+                    self.tallied = after
+                self.ballots = max(self.ballots, after)
+
+    def resetTally(self):
+        #Drops the live tally; it is re-read from the votes table when next needed
+        self.tally = None
+
+class Manager(SimplePlugin):
+    ''' 
+    This CherryPy plugin manages creation and operation of vote sessions.
+    Its thread sleeps until the next time a vote is due to open or close
+    (see LunchConfig.schedules).
+
+    Every lunch.py process runs one, but only the process holding the
+    "manager" lease in the DB acts on the schedule. The others stand by, and
+    one takes over if the lease goes `lease` seconds without being renewed.
+    The open event is kept in the event_windows table, so whichever process
+    leads carries on a vote that was open when it took over (or closes it,
+    if its time ran out in between).
+
+    "start-vote" and "end-vote" (from the admin page) can be published in any
+    process; they reach the leader through the DB. A reloaded schedule or
+    lease (see ConfigPlugin) applies straight away.
+    '''
+    def __init__(self, bus, lease=30):
+        super(Manager, self).__init__(bus)
+        self.holder = "%s:%d:%s"%(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lease = lease
+        self.leader = False
+        self.maxwait = 3600     #Seconds between schedule checks when nothing is due sooner
+
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.bus.log('Starting up vote manager %s'%self.holder)
+        self.bus.subscribe("start-vote", self.requestStart)
+        self.bus.subscribe("end-vote", self.requestEnd)
+        self.bus.subscribe("config-changed", self.configChanged)
+        self.running = True
+        self.thread = threading.Thread(target=self.work, name="Manager")
+        self.thread.daemon = True
+        self.thread.start()
+    #Once the DB is up, and before the first request can publish start-vote
+    start.priority = 70
 
-    def run(self):              
+    def stop(self):
+        self.bus.log('Stopping down vote manager')
+        self.bus.unsubscribe("start-vote", self.requestStart)
+        self.bus.unsubscribe("end-vote", self.requestEnd)
+        self.bus.unsubscribe("config-changed", self.configChanged)
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(30)
+            self.thread = None
+        self.resign()
+    #Stop before the DB plugin, to give up the lease
+    stop.priority = 25
+
+    def configChanged(self, settings, changed):
+        #Check the schedule again now, rather than when the old one was next due
+        if "cluster" in changed:
+            self.lease = settings["cluster"]["lease"]
+        if "lunch" in changed or "cluster" in changed:
+            self.wakeup.set()
+
+    def elect(self, db):
+        '''Takes or renews the "manager" lease; returns True while this process holds it'''
+        now = datetime.now()
+        expires = now + timedelta(seconds=self.lease)
+        held = db.query(Lease).filter(Lease.name=="manager", or_(Lease.holder==self.holder, Lease.expires<now)).update(
+            {"holder":self.holder, "expires":expires}, synchronize_session=False)
+        if not held and db.query(Lease).get("manager") is None:
+            try:
+                db.add(Lease(name="manager", holder=self.holder, expires=expires))
+                db.flush()
+                held = 1
+            except IntegrityError:
+                #Another process created it first
+                db.rollback()
+        db.commit()
+
+        if bool(held) != self.leader:
+            self.bus.log("%s the vote schedule"%("Took over" if held else "Lost"))
+        self.leader = bool(held)
+        return self.leader
+
+    def resign(self):
+        #Lets another process take over straight away
+        if self.leader:
+            db = self.bus.publish("bind-session")[0]
+            db.query(Lease).filter(Lease.name=="manager", Lease.holder==self.holder).update(
+                {"expires":datetime.now()}, synchronize_session=False)
+            self.bus.publish("commit-session")
+            self.leader = False
+
+    def requestStart(self, closes=None):
+        '''Opens a vote now, closing at closes (a datetime) or the end of the current scheduled window'''
         db = self.bus.publish("bind-session")[0]
-        D, T = self.now()                
-        if self.eventid is None:
-            if D in cfg.time_days and T >= cfg.time_start and T < cfg.time_end:
-                #Start a new vote                
-                self.startVote(db)
-        else:
-            if T >= cfg.time_end:
-                #End the current vote
-                self.endVote(db)     
-        self.bus.publish("commit-session")
+        db.add(VoteRequest(closes=closes))
+        db.commit()
+        self.wakeup.set()
 
-    def now(self):
-        #Returns the day of the week (0==Monday) and the current time
-        now = datetime.today()
-        return now.weekday(), time(now.hour, now.minute)
+    def requestEnd(self):
+        '''Closes the open vote now'''
+        #Ending the window stops ballots being taken in every process; the leader then tallies it
+        now = datetime.now()
+        db = self.bus.publish("bind-session")[0]
+        db.query(EventWindow).filter(EventWindow.closed==False, EventWindow.closes>now).update(
+            {"closes":now}, synchronize_session=False)
+        db.commit()
+        self.bus.publish("event-changed")
+        self.wakeup.set()
+
+    def work(self):
+        while self.running:
+            db = self.bus.publish("bind-session")[0]
+            self.bus.publish("start-scope", "manager")
+            try:
+                wait = self.run(db)
+                self.bus.publish("commit-session")
+            except Exception:
+                self.bus.log("Vote manager error", traceback=True)
+                db.rollback()
+                db.remove()
+                wait = 60
+            self.bus.publish("end-scope", "lunch_manager_tick")
+            self.wakeup.wait(wait)
+            self.wakeup.clear()
+
+    def run(self, db):
+        '''Opens or closes a vote if one is due and this process is the leader.
+        Returns the number of seconds until it should run again'''
+        if not self.elect(db):
+            return self.lease/3.0
+
+        now = datetime.now()
+        window = db.query(EventWindow).filter(EventWindow.closed==False).order_by(EventWindow.opens.desc()).first()
+        requests = db.query(VoteRequest).order_by(VoteRequest.id).all()
+        for R in requests:
+            db.delete(R)
+
+        if window is not None and now >= window.closes:
+            #End the current vote
+            self.endVote(db, window)
+            window = None
+
+        if window is None:
+            if requests:
+                due = self.dueWindow(db, now, held=True)
+                closes = requests[-1].closes or (due[1] if due else now + self.duration())
+                window = self.startVote(db, closes)
+            else:
+                due = self.dueWindow(db, now)
+                if due is not None:
+                    #Start a new vote                
+                    window = self.startVote(db, due[1])
+        elif requests:
+            self.bus.log("A vote is already open; not starting another")
+
+        if window is not None:
+            due = window.closes
+        else:
+            due = min([S for S, E in self.windows(now) if S > now] or [None])
+        wait = min(self.maxwait, self.lease/3.0)
+        if due is not None:
+            wait = min(wait, (due - now).total_seconds())
+        return max(0, wait)
+
+    def windows(self, now, days=8):
+        #Returns the scheduled (open, close) datetimes from today through the next week, in order
+        found = []
+        for offset in range(days):
+            day = now.date() + timedelta(offset)
+            for weekdays, start, end in cfg.schedules:
+                if day.weekday() in weekdays:
+                    found.append((datetime.combine(day, start), datetime.combine(day, end)))
+        return sorted(found)
+
+    def dueWindow(self, db, now, held=False):
+        '''Returns the scheduled (open, close) window that now falls in, or None.
+        Unless held=True, a window is skipped if a vote has already been held in it'''
+        for S, E in self.windows(now, 1):
+            if S <= now < E:
+                if held or db.query(EventWindow).filter(EventWindow.opens<E, EventWindow.closes>S).count() == 0:
+                    return S, E
+        return None
+
+    def duration(self):
+        #How long a vote started by hand outside of any scheduled window lasts
+        weekdays, start, end = cfg.schedules[0]
+        return datetime.combine(date.today(), end) - datetime.combine(date.today(), start)
 
     def today(self):
         #Returns the date (with time zeroed out)
         now = datetime.today()
         return date(now.year, now.month, now.day)
 
-    def startVote(self, db):
+    def startVote(self, db, closes):
         self.bus.log("*** Starting a new vote!")
         choices = self.getChoices(db)
+        if not choices:
+            self.bus.log("No enabled restaurants to vote on; add some on the admin page")
+            return
+        if len(choices) < cfg.ballot_size:
+            self.bus.log("Only %d restaurants to vote on"%len(choices))
         event = Event()
-        event.choices = [Choice(num=i, restaurant=choices[i].id) for i in range(5)]            
         db.add(event)
+        db.flush()
+        #One executemany for the whole ballot
+        db.bulk_insert_mappings(Choice, [{"event":event.id, "num":i, "restaurant":R} for i, R in enumerate(choices)])
+        window = EventWindow(event=event.id, opens=datetime.now(), closes=closes)
+        db.add(window)
         db.commit()
-        self.eventid = event.id
+        self.bus.publish("event-changed")
+        self.bus.publish("invalidate-leaderboard")
+
+        #Render the shared part of the email once; only the link differs per user
+        snapshot = eventSnapshot(db, event, closes)
+        email = templates.partial("invite.html", date=event.date, close=closes.strftime("%H:%M"),
+                                  choices="\n".join("<li>%s</li>"%C.name for C in snapshot.choices))
 
         for user in db.query(User).all():
             link = "http://%s/vote?u=%s"%(cfg.hostname, user.email)
 
-            email = '''
-            <html><body>
-            <h1>Lunch Today!</h1>
-            <p>The lunch ballot is now open for %s.
-            <a style="font-weight: bold;" href="%s">Vote Here!</a>
-            </p>
-            <p><b>Voting will be open until %s today.</b></p>
-            <p>If you can't make it to lunch this week, ignore this email for now.</p>
-            <p>Today's options are:
-                <ul>
-            '''%(event.date, link, cfg.time_end.strftime("%H:%M"))
-            for c in event.choices:
-                email += "<li>%s</li>"%(db.query(Restaurant).join(Choice).filter(Choice.id==c.id).one().name)
-            email +='''
-                </ul>
-            </p>
-            </body></html>
-            '''
-
             self.bus.log("Emailing %s"%user.email)
-            self.mail.sendhtml([user.email], "Lunch Vote Open %s"%event.date, email, test=DEBUG)
-            sleep(15)
+            queueMail(db, [user.email], "Lunch Vote Open %s"%event.date, email.safe_substitute(link=link))
+        db.commit()
+        self.bus.publish("mail-queued")
+        return window
 
-    def endVote(self, db):
+    def endVote(self, db, window):
         self.bus.log("*** Voting has closed!")
-        event = self.getEvent()
-        results, tb_user = calculateVote(db, event, True)
+        event = db.query(Event).filter_by(id=window.event).one()
+        tally = self.bus.publish("get-tally", event.id, True)
+        results, tb_user = calculateVote(db, event, True, tally[0] if tally else None)
+        storeResults(db, event, results)
             
         if results is None:
+            window.closed = True
+            db.commit()
             self.bus.log("Received no votes!")
         else:
+            db.commit()
             winner = results['winner']        
             
             #Increment the restaurant's win list and visited date
@@ -214,289 +494,427 @@ class Manager(Monitor):
             rest.last = datetime.today()
 
             event.winner = rest
-            event.tie_breaker = tb_user
+            event.tiebreaker = tb_user
+            window.closed = True
             db.commit()
 
             #Recalculate the restaurant ranking
             calculateRank(db, update=True)
+            self.bus.publish("invalidate-leaderboard")
 
             #Email the users who voted only
             attendees = db.query(User).join(Vote).filter(Vote.event==event.id).all()
-            email = '''
-            <html><body>
-            <h1>Lunch Today:<br/>%s</h1>
-            <p>The lunch ballot is closed for %s.</p>
-            <p>Who is coming today:
-                <ul>
-            '''%(winner, event.date)
-            for user in attendees:
-                email += "<li>%s</li>"%(user.name)
-            email +='''
-                </ul>
-            </p>
-            '''
-
-            if tb_user is not None:
-                email += "<p>This week's tie-breaker was: %s</p>"%(tb_user.name)
-            
-            email += "</body></html>"            
+            email = templates.render("results.html", winner=winner, date=event.date,
+                attendees="\n".join("<li>%s</li>"%user.name for user in attendees),
+                tiebreaker=templates.render("tiebreaker.html", name=tb_user.name) if tb_user is not None else "")
 
             self.bus.log("Emailing Results")
-            self.mail.sendhtml([user.email for user in attendees], "Lunch Vote Closed %s"%event.date, email, test=DEBUG)
+            queueMail(db, [user.email for user in attendees], "Lunch Vote Closed %s"%event.date, email)
+            db.commit()
+            self.bus.publish("mail-queued")
 
-        self.eventid = None
+        self.bus.publish("event-changed")
 
     def getChoices(self, db):
         '''
-            Chooses a restaurant list for an event by:
-            1) sort by rank 
-            2) dividing the list into "thirds"
-            3) selecting one from each third
-            4) randomly selecting from the list up to self.choices    
-            *) TODO: promoting restaurants without any votes        
+            Chooses the restaurant ids for an event's ballot by:
+            1) ranking the enabled restaurants not visited in the last cfg.norepeat days
+            2) dividing the ranked list into cfg.tiers tiers
+            3) selecting one from each tier
+            4) padding up to cfg.ballot_size with "new" restaurants (ie: ones that have
+               no votes), then with any of the rest
+            If too few restaurants are eligible, the enabled ones visited longest ago
+            fill the ballot, which is only short if there aren't enough restaurants.
+            The filtering, ordering and sampling all happen in the DB (see the
+            ix_restaurants_enabled_rank index), so only the chosen ids are read.
         '''
-        votedate = self.today()
-        restaurants = db.query(Restaurant).all()
-
-        #Select restaurants out of the noRepeatWeeks range, and sort by rank                
-        validRestaurants = [R for R in restaurants if R.last <= votedate - timedelta(1+cfg.norepeat)]        
-        ranked = sorted(validRestaurants, key=lambda I:I.rank, reverse=True)
-
-        #Divide into "thirds"
-        third = len(ranked)/3
-        choices = [random.choice(ranked[:third]),
-                   random.choice(ranked[third:-third]),
-                   random.choice(ranked[-third:])]
-
-        rem = [R for R in ranked if R not in choices]
-        ranked = [R for R in rem if R.rank > 0]
-        new = [R for R in rem if R.rank==0]
-        
-        #Attempt to pad the list with "new" restaurants (ie: ones that have no votes)
-        if len(new) >= 2:
-            choices.extend(random.sample(new, 2))
-        else:
-            #Not enough new restaurants; randomly select from the rest
-            choices.extend(new)
-            choices.extend(random.sample(ranked, 5-len(choices)))
+        cutoff = self.today() - timedelta(1+cfg.norepeat)
+        enabled = db.query(Restaurant.id).filter(Restaurant.enabled==True)
+        eligible = enabled.filter(Restaurant.last<=cutoff)
+        size = cfg.ballot_size
+        choices = []
+
+        def pad(query, *order):
+            #Adds random picks from query (after any order given) until the ballot is full
+            if len(choices) < size:
+                if choices:
+                    query = query.filter(~Restaurant.id.in_(choices))
+                choices.extend(R[0] for R in query.order_by(*(order + (func.random(),))).limit(size-len(choices)))
+
+        #One from each tier of the ranked list
+        count = eligible.count()
+        tiers = min(cfg.tiers, size, count)
+        ranked = eligible.order_by(Restaurant.rank.desc(), Restaurant.id)
+        for t in range(tiers):
+            choices.append(ranked.offset(random.randrange(t*count/tiers, (t+1)*count/tiers)).limit(1).scalar())
+
+        pad(eligible.filter(Restaurant.rank==0))
+        pad(eligible)
+        #Small pool: allow recently visited restaurants, oldest visit first
+        pad(enabled, Restaurant.last)
 
         #randomize the output!            
         random.shuffle(choices)
         return choices
 
+LeaderRow = namedtuple("LeaderRow", ["rank", "name", "website", "visits", "last"])
+LeaderBoard = namedtuple("LeaderBoard", ["rows", "events", "votes", "tag"])
+
+class Leaderboard(SimplePlugin):
+    '''
+    This CherryPy plugin caches the homepage leaderboard: the restaurants in
+    rank order along with the event and vote counts. The snapshot is built on
+    the first "get-leaderboard" after an "invalidate-leaderboard", so page hits
+    in between are served from memory without touching the DB.
+
+    Other lunch.py processes can't invalidate it, so when there are several,
+    pass maxage to rebuild a snapshot once it is that many seconds old.
+    '''
+    def __init__(self, bus, maxage=None):
+        super(Leaderboard, self).__init__(bus)
+        self.lock = threading.Lock()
+        self.board = None       #(LeaderBoard, when it was built)
+        self.version = 0
+        self.maxage = timedelta(seconds=maxage) if maxage else None
+
+    def start(self):
+        self.bus.subscribe("get-leaderboard", self.get)
+        self.bus.subscribe("invalidate-leaderboard", self.invalidate)
+
+    def stop(self):
+        self.bus.unsubscribe("get-leaderboard", self.get)
+        self.bus.unsubscribe("invalidate-leaderboard", self.invalidate)
+
+    def invalidate(self):
+        #Call after the change has been committed
+        with self.lock:
+            self.board = None
+            self.version += 1
+
+    def get(self, db):
+        cached, version = self.board, self.version
+        now = datetime.now()
+        if cached is None or (self.maxage is not None and now - cached[1] > self.maxage):
+            cached = (self.build(db), now)
+            with self.lock:
+                #Don't cache a snapshot that was invalidated while it was being built
+                if self.version == version:
+                    self.board = cached
+        return cached[0]
+
+    def build(self, db):
+        rankings = calculateRank(db)
+        rows = [LeaderRow(rankings[name], name, website, visits, last) for name, website, visits, last in
+                db.query(Restaurant.name, Restaurant.website, Restaurant.visits, Restaurant.last).all()]
+        rows.sort(key=lambda R:R.rank, reverse=True)
+        rows, events, votes = tuple(rows), db.query(Event).count(), db.query(Vote).count()
+        #The tag depends only on the contents, so every process gives the same board the same ETag
+        return LeaderBoard(rows, events, votes, httpcache.etag(rows, events, votes))
+
+class ResultsVersion(SimplePlugin):
+    '''
+    This CherryPy plugin caches what the results pages' ETag is built from
+    (see Lunch.results_tag): counts that change when an event opens, closes
+    or gets a ballot, or when a restaurant or person is removed. They are
+    read from the DB on the first "get-results-version" after this process
+    changes any of them ("invalidate-leaderboard" or "event-changed"), so a
+    revalidation usually costs no queries.
+
+    Other lunch.py processes' changes are seen once the counts are maxage
+    seconds old, as with the Leaderboard.
+    '''
+    def __init__(self, bus, maxage=None):
+        super(ResultsVersion, self).__init__(bus)
+        self.lock = threading.Lock()
+        self.counts = None      #(counts, when they were read)
+        self.version = 0
+        self.maxage = timedelta(seconds=maxage) if maxage else None
+
+    def start(self):
+        self.bus.subscribe("get-results-version", self.get)
+        self.bus.subscribe("invalidate-leaderboard", self.invalidate)
+        self.bus.subscribe("event-changed", self.invalidate)
+
+    def stop(self):
+        self.bus.unsubscribe("get-results-version", self.get)
+        self.bus.unsubscribe("invalidate-leaderboard", self.invalidate)
+        self.bus.unsubscribe("event-changed", self.invalidate)
+
+    def invalidate(self):
+        #Call after the change has been committed
+        with self.lock:
+            self.counts = None
+            self.version += 1
+
+    def get(self, db):
+        cached, version = self.counts, self.version
+        now = datetime.now()
+        if cached is None or (self.maxage is not None and now - cached[1] > self.maxage):
+            cached = (self.read(db), now)
+            with self.lock:
+                if self.version == version:
+                    self.counts = cached
+        return cached[0]
+
+    def read(self, db):
+        return tuple(db.query(db.query(func.max(Event.id)).as_scalar(),
+                              db.query(func.count(Event.winner_id)).as_scalar(),
+                              db.query(func.sum(EventWindow.ballots)).as_scalar(),
+                              db.query(func.count(EventWindow.event)).filter(EventWindow.closed==True).as_scalar(),
+                              db.query(func.count(Restaurant.id)).as_scalar(),
+                              db.query(func.count(User.id)).as_scalar()).one())
+
+class Profiler(object):
+    '''
+    The profiler pages, at /admin/profile/ behind the admin password. See
+    ProfilerPlugin for what each kind of report measures.
+    '''
+    #The handlers that can be profiled, as named by metricstool.handlerName
+    handlers = ["/", "/vote", "/results", "/admin", "/metrics", "/static"]
+
+    #Download formats: (content type, file suffix)
+    formats = {"text": ("text/plain", "txt"),
+               "pstats": ("application/octet-stream", "pstats"),
+               "collapsed": ("text/plain", "collapsed.txt"),
+               "counts": ("text/tab-separated-values", "tsv")}
+
+    @cherrypy.expose
+    def index(self, action="", handler="/", count=10, thread="Manager", seconds=30, **kwargs):
+        notes = []
+
+        try:
+            if action == 'profile':
+                count = max(1, min(int(count), 1000))
+                if handler not in self.handlers:
+                    raise ValueError("Unknown handler %s"%handler)
+                cherrypy.engine.publish("profile-requests", handler, count)
+                notes.append("Profiling the next %d requests to %s<br/>"%(count, handler))
+            elif action == 'sample':
+                seconds = max(1, min(int(seconds), 600))
+                if cherrypy.engine.publish("sample-thread", thread, seconds)[0] is None:
+                    notes.append("Can't sample thread %s: it isn't running, or a sample is already being taken<br/>"%thread)
+                else:
+                    notes.append("Sampling thread %s for %d seconds<br/>"%(thread, seconds))
+            elif action == 'memory':
+                cherrypy.engine.publish("count-objects")
+        except ValueError as e:
+            notes.append("%s<br/>"%e)
+
+        handler, remaining, sampled = cherrypy.engine.publish("get-profiling")[0]
+
+        site = [page.header(subtitle="Profiler")]
+        site.extend(notes)
+        if handler is not None:
+            site.append("<p>Profiling %d more requests to %s</p>"%(remaining, handler))
+        if sampled is not None:
+            site.append("<p>Taking a sample: %s</p>"%sampled.title)
+
+        site.append(page.PROFILE_REQUESTS.substitute(options="".join(
+            page.PROFILE_OPTION.substitute(value=H, selected=" selected" if H == "/results" else "") for H in self.handlers)))
+        threads = sorted(T.name for T in threading.enumerate())
+        site.append(page.PROFILE_SAMPLE.substitute(options="".join(
+            page.PROFILE_OPTION.substitute(value=T, selected=" selected" if T == "Manager" else "") for T in threads)))
+        site.append(page.PROFILE_MEMORY)
+
+        site.append(page.PROFILE_REPORTS_HEAD)
+        for report in cherrypy.engine.publish("get-reports")[0]:
+            site.append(page.PROFILE_REPORT_ROW.substitute(title=report.title, taken=report.created.strftime("%Y-%m-%d %H:%M:%S"),
+                count=report.count, running="" if report.done else " (running)",
+                links=" ".join(page.LINK.substitute(href="/admin/profile/report?id=%d&format=%s"%(report.id, F), text=F)
+                               for F in report.formats())))
+        site.append("</table>")
+        site.append(page.footer())
+        return "".join(site)
+
+    @cherrypy.expose
+    def report(self, id, format="text"):
+        try:
+            report = cherrypy.engine.publish("get-report", int(id))[0]
+        except ValueError:
+            report = None
+        if report is None or format not in report.formats():
+            raise cherrypy.HTTPError(404)
+
+        ctype, suffix = self.formats[format]
+        cherrypy.response.headers['Content-Type'] = ctype
+        cherrypy.response.headers['Content-Disposition'] = 'attachment; filename="lunch-%s-%d.%s"'%(report.kind, report.id, suffix)
+        if format == "pstats":
+            return report.pstats()
+        elif format == "collapsed":
+            return report.collapsed()
+        elif format == "counts":
+            return report.counts()
+        return report.text()
+
 class Lunch(object):
     ''' This object encapsulates the entire website '''
 
+    #The leaderboard table, rendered once per snapshot: (board tag, HTML)
+    leaderboard = (None, "")
+
     def header(self, title="Lunch Today", subtitle=""):
         #Common header HTML
-        pagetitle = "%s%s"%(title, (": " + subtitle) if subtitle else "")
-        head = '''<html><head>
-        <title>%s</title>
-        <link rel="stylesheet" href="static/style.css"/>
-        <link rel="apple-touch-icon" sizes="180x180" href="/static/apple-touch-icon.png">
-        <link rel="icon" type="image/png" sizes="32x32" href="/static/favicon-32x32.png">
-        <link rel="icon" type="image/png" sizes="16x16" href="/static/favicon-16x16.png">
-        <link rel="manifest" href="/static/manifest.json">
-        <link rel="mask-icon" href="/static/safari-pinned-tab.svg" color="#cf9e5c">
-        <link rel="shortcut icon" href="/static/favicon.ico">
-        <meta name="msapplication-config" content="/static/browserconfig.xml">
-        <meta name="theme-color" content="#ffffff">        
-        </head>'''%pagetitle   
-        head += "<body><div id=header><b>%s</b>"%(title) 
-        if subtitle:
-            head += ": %s</div>"%subtitle
-        else:
-            head += "</div>"
-        head += "<div id=menu>"
-        # head += "<div class=menu_button><a href=/admin>Admin</a></div>"
-        head += "<div class=menu_button><a href=/results>Results</a></div>"
-        head += "<div class=menu_button><a href=/>Home</a></div>"
-        head += "</div>"
-        return head
+        return page.header(title, subtitle)
 
     def footer(self):
         #Common footer HTML
-        #foot = '<div id=footer>Lunch</div></body></html>'
-        foot = '</body></html>'
-        return foot
+        return page.footer()
+
+    def stream(self, render, *args):
+        '''
+        Streams the pieces of a page from render(db, *args). The request's
+        DB session is committed as soon as the handler returns, before the
+        body is written out, so the page is read through a session of its own.
+        '''
+        cherrypy.response.stream = True
+        def body():
+            db = cherrypy.engine.publish("bind-session")[0]
+            try:
+                for chunk in page.chunks(render(db, *args)):
+                    yield chunk
+            finally:
+                cherrypy.engine.publish("commit-session")
+        return body()
 
     @cherrypy.expose
     def index(self):
         db = cherrypy.request.db
-        datelimit = datetime.today() - timedelta(cfg.norepeat)        
-
-        #Recalculate the restaurant ranking
-        calculateRank(db, update=True)
-
-        # site = "<html><head><title>Lunch</title></head>"
-        site = self.header()
-        
-        site += '<h2>Restaurant Leaderboard</h2><br/>'
-        site += '<table>'
-        site += '<tr><th>Rank</th><th>Restaurant</th><th>Visits</th><th>Last Visit</th></tr>'
-        query = db.query(Restaurant).order_by(Restaurant.rank.desc())        
-        for row in query.all():
-            rank = 1
-            site += '<tr>'
-            site += '<td>%.2f</td>'%(row.rank)
-            if row.website:
-                site += '<td><a href=%s>%s</a></td>'%(row.website, row.name)    
-            else:
-                site += '<td>%s</td>'%(row.name)
-            site += '<td>%d</td>'%(row.visits)
-            site += '<td>%s</td>'%(row.last)            
-            site += '</tr>'
-        site += '</table>'
-
-        eventcount = db.query(Event).count()
-        site += "<h3>Voting events: %d</h3>"%eventcount
-        votecount = db.query(Vote).count()
-        site += "<h3>Total votes cast: %d</h3>"%votecount        
-
-        # site += "</body></html>"
-        site += self.footer()
-        return site
+        board = cherrypy.engine.publish("get-leaderboard", db)[0]
+        httpcache.validate(httpcache.etag(board.tag, page.versions()))
+
+        tag, table = self.leaderboard
+        if tag != board.tag:
+            table = [page.LEADER_HEAD]
+            for row in board.rows:
+                table.append(page.LEADER_ROW.substitute(rank="%.2f"%row.rank, visits=row.visits, last=row.last,
+                    name=page.LINK.substitute(href=row.website, text=row.name) if row.website else row.name))
+            table.append(page.LEADER_TOTALS.substitute(events=board.events, votes=board.votes))
+            table = "".join(table)
+            self.leaderboard = (board.tag, table)
+        return "".join([self.header(), table, self.footer()])
 
     @cherrypy.expose
     def vote(self, u="", action="", **args):
-        ''' 
+        '''
         The vote page takes in an email address as parameter u.
         Displays a vote dialog with no action; enters/replaces a vote when
         action="vote"
         '''
         db = cherrypy.request.db
-        event = cherrypy.engine.publish("get-event")[0]
+        event = cherrypy.engine.publish("get-snapshot")[0]
+        if event is not None and datetime.now() >= event.close:
+            #The Manager hasn't closed it yet, but it's past time
+            event = None
 
         #voteinput[x] is the rank (1-5) of choice[x] or None
+        nchoices = len(event.choices) if event is not None else 0
         try:
-            voteinput = [int(args["c%d"%i]) if "c%d"%i in args else None for i in range(5)]
+            voteinput = [int(args["c%d"%i]) if "c%d"%i in args else None for i in range(nchoices)]
         except ValueError:
-            voteinput = [None, None, None, None, None]
+            voteinput = [None]*nchoices
+        voteinput = [V if V in range(1, 6) else None for V in voteinput]
 
-        site = self.header(subtitle="Vote") 
+        site = [self.header(subtitle="Vote")]
 
-        #TODO: Verify the user is in the Users table and check if they've voted in this event already        
+        #TODO: Verify the user is in the Users table and check if they've voted in this event already
         person = db.query(User).filter_by(email=u).one_or_none()
         if person is None:
-            site += "<h2>You aren't allowed to vote</h2>"            
+            site.append("<h2>You aren't allowed to vote</h2>")
         else:
-            site += "<h2>Hello, %s</h2>"%(person.name)                        
+            site.append("<h2>Hello, %s</h2>"%(person.name))
 
             if event is None:
-                site += "<h3>Voting is closed!</h3>"
+                site.append("<h3>Voting is closed!</h3>")
             else:
-                oldvotes = db.query(Vote).join(User).filter(Vote.event==event.id, User.email==u).all()
-
                 if action=='vote' and all(voteinput):
-                    # SUBMITTING A VOTE
-                    newvotes = [Vote(user=person.id, event=event.id, restaurant=event.choices[i].restaurant, rank=voteinput[i]) for i in range(5)]
-
-                    if len(oldvotes)==0:
-                        site += "<h2>Vote received!</h2>"
-                        db.add_all(newvotes)
+                    # SUBMITTING A VOTE: the vote writer commits it along with any other
+                    # ballots that arrived at the same time
+                    ranks = dict((choice.restaurant, rank) for choice, rank in zip(event.choices, voteinput))
+                    userid = person.id
+                    db.commit()     #Return this request's connection to the pool while it waits
+                    updated = cherrypy.engine.publish("submit-vote", event.id, userid, ranks)[0]
+                    if updated is None:
+                        site.append("<h3>Voting is closed!</h3>")
+                        site.append(self.footer())
+                        return "".join(site)
+                    elif updated:
+                        site.append("<h2>Updated vote received!</h2>")
                     else:
-                        site += "<h2>Updated vote received!</h2>"
-                        [db.delete(v) for v in oldvotes]
-                        db.add_all(newvotes)
+                        site.append("<h2>Vote received!</h2>")
 
                     #Display the received vote for verification
-                    site += '<table>'      
-                    #for rest, rank in db.query(Restaurant.name, Vote.rank).join(Choice).join(Vote).join(Event).filter(Event.id==event.id, Vote.user==person.id).order_by(Choice.num).all():
-                    for rest, rank in db.query(Restaurant.name, Vote.rank).join(Vote).filter(Vote.event==event.id, Vote.user==person.id).all():
-                        site += '''<tr>                
-                            <td>%s</td>
-                            <td>%s</td>                        
-                        </tr>'''%(rest,"&#9733;"*rank)
-                    site += '</table>'    
-
-                    # cherrypy.engine.publish("calculate")              
+                    site.append('<table>')
+                    for choice, rank in zip(event.choices, voteinput):
+                        site.append(page.VOTE_ROW.substitute(name=choice.name, stars="&#9733;"*rank))
+                    site.append('</table>')
 
                 else:
                     # Display the vote table for the user
                     # If incomplete voteinput was passed in already, populate the table with it
-                    site += "<h2>Lunch Vote for %s</h2>"%(event.date)
-                    if len(oldvotes) > 0:
-                        site += "<h3>You have already voted, but you can change your vote.</h3>"
+                    oldvotes = db.query(Vote.id).filter(Vote.event==event.id, Vote.user==person.id).count()
+                    site.append("<h2>Lunch Vote for %s</h2>"%(event.date))
+                    if oldvotes > 0:
+                        site.append("<h3>You have already voted, but you can change your vote.</h3>")
                     if any(voteinput):
-                        site += "<h3>You must rank all choices before voting.</h3>"
-                    site += '''<p>Vote below by ranking each of these restaurants with a number of stars, 
-                    where &#9733; is "Meh," and &#9733;&#9733;&#9733;&#9733;&#9733; is "I really want to go here!"</p>
-                    <p>Your restaurant choice for this week will be the highest-ranked choice(s) voted for. If you're forced to pick the lesser of two evils, rank them accordingly!</p>
-                    <p>You can give multiple restaurants the same rank if you like them equally. 
-                    The rank you give restaurants will affect their future rankings.</p>
-                    <p>If you aren't able to attend this week, please don't vote.</p>'''
-                    site += '<form method="post" action="vote">\n'
-                    site += '<input type="hidden" name="u", value="%s">\n'%u
-                    site += '<table class=table_vote>\n'
-                    site += '''<tr><th/>
-                    <th>&#9733;&#9733;&#9733;&#9733;&#9733;</th>
-                    <th>&#9733;&#9733;&#9733;&#9733;</th>
-                    <th>&#9733;&#9733;&#9733;</th>
-                    <th>&#9733;&#9733;</th>
-                    <th>&#9733;</th>
-                    '''
-                    for i, rest in enumerate(db.query(Restaurant).join(Choice).filter(Choice.event==event.id).order_by(Choice.num).all()):
-                        if rest.website:
-                            site += '<tr><td><a href=%s>%s</a></td>'%(rest.website, rest.name)    
-                        else:
-                            site += '<tr><td>%s</td>'%(rest.name)
+                        site.append("<h3>You must rank all choices before voting.</h3>")
+                    site.append(page.VOTE_INSTRUCTIONS)
+                    site.append(page.VOTE_FORM.substitute(u=u))
+                    for i, rest in enumerate(event.choices):
+                        site.append('<tr><td>%s</td>'%(page.LINK.substitute(href=rest.website, text=rest.name) if rest.website else rest.name))
                         for value in range(5,0,-1):
-                            site += '<td><input type="radio" name="c%d" value="%d" %s></td>\n'%(
-                                i, value,
-                                "checked" if "c%d"%i in args and str(value)==args["c%d"%i] else "")
-                        site += '</tr>\n'
-                    site += '</table>\n'
-                    site += '<button type="submit" name="action" value="vote">Vote</button>\n'
-                    site += '</form>\n'
-
-        site += self.footer()
-        return site
-
-    def results_table(self, event):
-        '''
-        This helper prints a table of votes for the input event
-        '''
-
-        db = cherrypy.request.db
+                            site.append(page.VOTE_RADIO.substitute(choice=i, value=value,
+                                checked="checked" if "c%d"%i in args and str(value)==args["c%d"%i] else ""))
+                        site.append('</tr>\n')
+                    site.append(page.VOTE_SUBMIT)
 
-        site = '<hr/><h3>Votes Collected</h3>'
+        site.append(self.footer())
+        return "".join(site)
 
-        #print out the header row (restaurant names)
-        site += "<table class=table_results>\n"
-        # site += "<caption>Votes recorded</caption>"
-        site += "<tr><th/>"
+    def results_table(self, db, event):
+        '''
+        This helper yields a table of votes for the input event
+        '''
+        restaurants, votes = voteMatrix(db, event)
 
-        restaurants = [db.query(Restaurant).join(Choice).filter(Choice.id==c.id).one().name for c in event.choices]
+        yield '<hr/><h3>Votes Collected</h3>'
 
+        #print out the header row (restaurant names), then the votes (user name, rank, rank, rank, etc.)
+        yield "<table class=table_results>\n<tr><th/>"
         for r in restaurants:
-            site += "<th>%s</th>"%(r)
-        site += "</tr>\n"
-
-        #print out the votes (user name, rank, rank, rank, etc.)
-        #build a dictionary from a query and then display that.
-
-        #return a list of all votes for all users for a single event
-        votes = {}        
-        for name, rank, rest in db.query(User.name, Vote.rank, Restaurant.name).join(Vote).join(Restaurant).filter(Vote.event==event.id).all():
-            entry = votes.get(name, [-1, -1, -1, -1, -1])
-            entry[restaurants.index(rest)] = rank
-            votes[name] = entry
+            yield "<th>%s</th>"%(r)
+        yield "</tr>\n"
+        for u, ranks in votes:
+            yield page.RESULTS_ROW.substitute(name=u, ranks="".join("<td>%d</td>"%(rank) for rank in ranks))
+        yield "</table>\n"
 
-        for u in sorted(votes.keys()):
-            site += "<tr>"
-            site += "<td>%s</td>"%u
-            for i in range(5):
-                site += "<td>%d</td>"%(votes[u][i])
-            site += "</tr>\n"
-        site += "</table>\n"
-
-        return site
+    def results_tag(self, db, evtid, before, count):
+        '''
+        The ETag of a results page. It changes when an event opens, closes or
+        gets a ballot, or when a restaurant or person is removed (see
+        ResultsVersion); otherwise a revalidation is answered without
+        building the page.
+        '''
+        counts = cherrypy.engine.publish("get-results-version", db)[0]
+        return httpcache.etag(evtid, before, count, counts, page.versions())
 
     @cherrypy.expose
-    def results(self, evtid=None, count=10):
-        db = cherrypy.request.db
-        
-        #Current Event        
+    def results(self, evtid=None, before=None, count=10):
+        '''
+        Shows the results of event evtid (default: the open or latest event)
+        beside a page of the event list: `count` events, starting after
+        event id `before`.
+        '''
+        try:
+            evtid = int(evtid) if evtid else None
+            before = int(before) if before else None
+            count = min(max(int(count), 1), 100)
+        except ValueError:
+            raise cherrypy.HTTPError(400)
+        httpcache.validate(self.results_tag(cherrypy.request.db, evtid, before, count))
+        return self.stream(self.results_page, evtid, before, count)
+
+    def results_page(self, db, evtid, before, count):
+        #Current Event
         currentevent = cherrypy.engine.publish("get-event")[0]
         selectedevent = None
 
@@ -508,56 +926,61 @@ class Lunch(object):
                 selectedevent = db.query(Event).order_by(Event.id.desc()).first()
         else:
             selectedevent = db.query(Event).filter(Event.id==evtid).one_or_none()
-            
-        #All Events
-        events = db.query(Event).order_by(Event.date.desc(), Event.id.desc()).all()
 
-        site = self.header(subtitle="Results")
+        #A page of the event list
+        events, more = eventHistory(db, before, count)
+
+        def link(**params):
+            params = dict((K, V) for K, V in params.items() if V is not None)
+            return "/results" + ("?" + urllib.urlencode(sorted(params.items())) if params else "")
+
+        yield self.header(subtitle="Results")
 
         #Sidebar
-        site += "<div id=results_sidebar>"
-        site += "<h1>Event List</h1>"        
+        yield "<div id=results_sidebar><h1>Event List</h1>"
         if len(events)==0:
-            site += "<p>No Events</p>"
+            yield "<p>No Events</p>"
         for event in events:
-            site += "<p><a href=/results?evtid=%d>%s"%(event.id, event.date)
-            if event.winner:
-                site += ": %s"%(event.winner.name)
-            site += "</a></p>"
-        site += "</div>"
-
-        site += "<div id=results_content>"
+            yield page.EVENT_LINK.substitute(href=link(evtid=event.id, before=before, count=count), date=event.date,
+                                             name=(": %s"%(event.name)) if event.name else "")
+        if before is not None:
+            yield page.PAGE_LINK.substitute(href=link(evtid=evtid, count=count), text="Newest events")
+        if more:
+            yield page.PAGE_LINK.substitute(href=link(evtid=evtid, before=events[-1].id, count=count), text="Older events")
+        yield "</div>"
+
+        yield "<div id=results_content>"
         if selectedevent is None:
-            site += "<p>No events</p>"
+            yield "<p>No events</p>"
         else:
-            results, _ = calculateVote(db, selectedevent)            
+            tally = cherrypy.engine.publish("get-tally", selectedevent.id)
+            results = eventResults(db, selectedevent, tally[0] if tally else None)
 
-            site += "<h1>Results for %s</h1>"%(selectedevent.date)
+            yield "<h1>Results for %s</h1>"%(selectedevent.date)
             if selectedevent.winner:
-                site += "<h2>Winner: %s</h2>"%(selectedevent.winner.name)
+                yield "<h2>Winner: %s</h2>"%(selectedevent.winner.name)
             if results and 'tied_winners' in results:
-                print results['tied_winners']
-                site += "<p>Ties: "
-                site += ", ".join(results['tied_winners'])
-                site += "</p>"
+                yield "<p>Ties: %s</p>"%(", ".join(results['tied_winners']))
             if selectedevent.tiebreaker:
-                site += "<p>Tiebreaker: %s</p>"%(selectedevent.tiebreaker.name)
-            site += self.results_table(selectedevent)
-        site += "</div>"
-        
-        # for event in events:
-        #     if currentevent is not None and event.id == currentevent.id:
-        #         site += "<h2>Current Event</h2>"
-        #     site = self.results_table(site, event)
-        
-        site += self.footer()
-        return site
+                yield "<p>Tiebreaker: %s</p>"%(selectedevent.tiebreaker.name)
+            for piece in self.results_table(db, selectedevent):
+                yield piece
+        yield "</div>"
+
+        yield self.footer()
+
+    @cherrypy.expose
+    def metrics(self):
+        '''Request, query, scheduler and mail counters in the Prometheus text format'''
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        metrics = cherrypy.engine.publish("get-metrics")
+        return metrics[0] if metrics else ""
 
     @cherrypy.expose
-    def admin(self, action="", name="", visits=0, date="", email="", **kwargs):
+    def admin(self, action="", name="", visits=0, date="", email="", close="", **kwargs):
         db = cherrypy.request.db
-        
-        site = self.header(subtitle="Admin") 
+
+        notes = []
 
         cherrypy.log("ADMIN ACTION: %s"%action)
 
@@ -568,7 +991,7 @@ class Lunch(object):
             row.last = datetime(dt.year, dt.month, dt.day)
         elif action == 'decrement_visit':
             row = db.query(Restaurant).filter(Restaurant.name==name).one()
-            row.visits -= 1                           
+            row.visits -= 1
         elif action == 'add_restaurant':
             rows = db.query(Restaurant).filter(Restaurant.name==name).all()
             if len(rows) == 0:
@@ -579,77 +1002,71 @@ class Lunch(object):
                 R = Restaurant(name=name, visits=visits, last=date)
                 db.add(R)
             else:
-                site += "Restaurant \"%s\" already in database!<br/>"%name
+                notes.append("Restaurant \"%s\" already in database!<br/>"%name)
         elif action == 'del_restaurant':
             for row in db.query(Restaurant).filter(Restaurant.name==name).all():
                 db.delete(row)
         elif action == 'add_person':
-            P = User(name=name, email=email)
-            db.add(P)
+            if db.query(User).filter(User.email==email).count() == 0:
+                P = User(name=name, email=email)
+                db.add(P)
+            else:
+                notes.append("Email \"%s\" already in database!<br/>"%email)
         elif action == 'del_person':
-            for row in db.query(User).filter(User.name==name).all():         
+            for row in db.query(User).filter(User.name==name).all():
                 db.delete(row)
+        elif action == 'start_vote':
+            closes = None
+            try:
+                if close:
+                    closes = datetime.combine(datetime.today(), datetime.strptime(close, "%H:%M").time())
+            except ValueError:
+                notes.append("Close time \"%s\" isn't a time (HH:MM)<br/>"%cgi.escape(close))
+            else:
+                if closes is not None and closes <= datetime.now():
+                    notes.append("Close time %s has already passed<br/>"%closes.strftime("%H:%M"))
+                else:
+                    cherrypy.engine.publish("start-vote", closes)
+                    notes.append("Starting a vote<br/>")
+        elif action == 'end_vote':
+            cherrypy.engine.publish("end-vote")
+            notes.append("Closing the vote<br/>")
+
+        if action:
+            db.commit()
+            cherrypy.engine.publish("invalidate-leaderboard")
+
+        return self.stream(self.admin_page, notes)
+
+    #/admin/profile/, which shares the admin page's password
+    admin.profile = Profiler()
 
-        site += '<hr/>Restaurants in the list:<br/>'
-        site += '<table>'
-        site += '<tr><th/><th>Rank</th><th>Restaurant</th><th>Visits</th><th>Last Visit</th><th>Added</th></tr>'
-        Q = db.query(Restaurant).order_by(Restaurant.visits.desc())
-        R = [(K,0) for K in Q]
-        for row, rank in R:
-            site += '''<tr>
-                <td>                    
-                    <form style="float:right" method="post" action="admin">
-                        <input type="hidden" name="name" value="%s">
-                        <button type="submit" name="action" value="del_restaurant" onclick="return confirm('Are you sure you want to remove %s?');">X</button>
-                    </form>
-                </td>'''%(row.name, row.name)
-            site += '<td>%d</td>'%(rank)
-            site += '<td>%s</td>'%(row.name)
-            site += '''<td>%s
-                    <form style="float:right" method="post" action="admin">
-                        <input type="hidden" name="name" value="%s">
-                        <button type="submit" name="action" value="increment_visit">+</button>
-                        <button type="submit" name="action" value="decrement_visit">-</button>
-                    </form>
-                    </td>'''%(row.visits, row.name)
-            site += '<td>%s</td>'%(row.last)
-            site += '<td>%s</td>'%(row.added)
-            site += '</tr>'
-        site += '</table>'
-        site += '</br>'
-        site += '''<form method="post", action="admin">
-            Name<input type="text" name="name">
-            Visits<input type="number" name="visits" min="0" value=0>
-            Last Visit<input type="date" name="date">
-            <button class=button type="submit" name="action" value="add_restaurant">Add Restaurant</button>
-            </form>'''      
-
-        site += '<hr/>People:<br/>'
-        site += '<table>'
-        site += '<tr><th/><th>Name</td><th>Email</th><th>Tiebreaks</th></tr>'
-        Q = db.query(User).order_by(User.name)
+    def admin_page(self, db, notes):
+        yield self.header(subtitle="Admin")
+        for note in notes:
+            yield note
+
+        snapshot = cherrypy.engine.publish("get-snapshot")[0]
+        if snapshot is None:
+            yield page.ADMIN_START
+        else:
+            yield page.ADMIN_END.substitute(date=snapshot.date, close=snapshot.close.strftime("%H:%M"))
+
+        yield page.ADMIN_RESTAURANT_HEAD
+        Q = db.query(Restaurant.name, Restaurant.visits, Restaurant.last, Restaurant.added).order_by(Restaurant.visits.desc())
+        for row in Q:
+            yield page.ADMIN_RESTAURANT_ROW.substitute(name=row.name, rank=0, visits=row.visits,
+                                                      last=row.last, added=row.added)
+        yield page.ADMIN_RESTAURANT_FORM
+
+        yield page.ADMIN_PEOPLE_HEAD
+        Q = db.query(User.name, User.email, User.tb_count).order_by(User.name)
         for row in Q:
-            site += '''<tr>
-                <td>                    
-                    <form style="float:right" method="post" action="admin">
-                        <input type="hidden" name="name" value="%s">
-                        <button type="submit" name="action" value="del_person" onclick="return confirm('Are you sure you want to remove user %s?');">X</button>
-                    </form>
-                </td>'''%(row.name, row.name)
-            site += '<td>%s</td>'%(row.name)
-            site += '<td>%s</td>'%(row.email)
-            site += '<td>%d</td>'%(row.tb_count)    
-            site += '</tr>'
-        site += '</table>'
-        site += '</br>'
-        site += '''<form method="post", action="admin">
-            Name<input type="text" name="name" required>
-            Email<input type="email" name="email">            
-            <button type="submit" name="action" value="add_person">Add User</button>
-            </form>'''  
-
-        site += self.footer()
-        return site
+            yield page.ADMIN_PEOPLE_ROW.substitute(name=row.name, email=row.email, tb_count=row.tb_count)
+        yield page.ADMIN_PEOPLE_FORM
+        yield page.ADMIN_PROFILE
+
+        yield self.footer()
 
 
 if __name__ == '__main__':
@@ -658,10 +1075,14 @@ if __name__ == '__main__':
 
     #Accept all inputs
     cherrypy.config.update({
-        'server.socket_host': '0.0.0.0',
-        'server.socket_port': 8080,
+        'server.socket_host': str(cfg.server.get("host", "0.0.0.0")),
+        'server.socket_port': int(cfg.server.get("port", 8080)),
         })
 
+    #Let several processes share the port (see README.md)
+    if cfg.server.get("reuse_port", False):
+        cherrypy.config.update({'server.instance': 'reuseport.ReusePortServer'})
+
     #Disable auto reload
     cherrypy.config.update({
         'global': {
@@ -672,7 +1093,9 @@ if __name__ == '__main__':
 
     conf = {
         '/': {
-            'tools.db.on': True
+            'tools.db.on': True,
+            'tools.metrics.on': True,
+            'tools.compress.on': True,
         },
 
         '/admin': {
@@ -683,15 +1106,30 @@ if __name__ == '__main__':
         },
 
         '/static': {
-            'tools.staticdir.on': True,
-            'tools.staticdir.dir': os.path.join(os.getcwd(), "static")
+            'tools.db.on': False,
+            'tools.assets.on': True,
+            'tools.assets.section': '/static',
+            'tools.assets.dir': page.STATIC_DIR,
         }
     }
 
-    if DEBUG:
-        Manager(cherrypy.engine, 1).subscribe()
-    else:
-        Manager(cherrypy.engine, 60).subscribe()
-    SAEnginePlugin(cherrypy.engine, 'sqlite:///'+cfg.dbfile).subscribe()
+    #init the DB: one engine shared by everything in this process
+    lunchdb = LunchDB(cfg.dbfile, cfg.database)
+    initRatings(Session())
+
+    ConfigPlugin(cherrypy.engine, cfg, cfg.cluster.get("poll", 5)).subscribe()
+    MetricsPlugin(cherrypy.engine, lunchdb.engine, debug=DEBUG).subscribe()
+    ProfilerPlugin(cherrypy.engine).subscribe()
+    Manager(cherrypy.engine, cfg.cluster.get("lease", 30)).subscribe()
+    OpenEvent(cherrypy.engine, cfg.cluster.get("poll", 5)).subscribe()
+    SAEnginePlugin(cherrypy.engine, engine=lunchdb.engine).subscribe()
+    Leaderboard(cherrypy.engine, cfg.cluster.get("poll", 5)).subscribe()
+    ResultsVersion(cherrypy.engine, cfg.cluster.get("poll", 5)).subscribe()
+    VoteWriterPlugin(cherrypy.engine).subscribe()
+    MailQueuePlugin(cherrypy.engine, cfg.smtp, cfg.smtp.get("workers", 2), cfg.smtp.get("retries", 5),
+                    cfg.smtp.get("backoff", 60), test=DEBUG).subscribe()
     cherrypy.tools.db = SATool()
+    cherrypy.tools.metrics = MetricsTool()
+    cherrypy.tools.compress = cherrypy.Tool('before_finalize', httpcache.compress, priority=90)
+    cherrypy.tools.assets = cherrypy._cptools.HandlerTool(httpcache.assets)
     cherrypy.quickstart(Lunch(), '/', conf)
\ No newline at end of file
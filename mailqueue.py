@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy.sql.expression import or_
+from cherrypy.process import plugins
+
+from sqlalchemy.exc import IntegrityError
+from LunchDB import Outbox, Lease
+from LunchMail import LunchMail
+
+__all__ = ['MailQueuePlugin', 'queueMail']
+
+def queueMail(db, toaddr, subject, body, html=True):
+    """
+    Adds a message to the outbox as part of the caller's transaction.
+    Publish 'mail-queued' once it is committed to wake up the workers.
+    """
+    db.add(Outbox(toaddr=",".join(toaddr), subject=subject, body=body, html=html))
+
+class MailQueuePlugin(plugins.SimplePlugin):
+    def __init__(self, bus, smtp, workers=2, retries=5, backoff=60, timeout=300, test=False):
+        """
+        This plugin delivers the mail in the outbox table with a pool of
+        worker threads, each holding its own SMTP session. The smtp "rate"
+        applies to all the processes sharing the DB together: each message
+        takes the next send slot from the "mail-rate" row of the leases table
+        (see reserve).
+
+        A failed message is retried up to `retries` times, waiting `backoff`
+        seconds and doubling each time, and is then marked failed. The queue
+        lives in the DB, so anything still queued survives a restart.
+
+        Several lunch.py processes can share the outbox. Each claimed message
+        records which process claimed it and when; one left 'sending' for
+        `timeout` seconds was interrupted (its process stopped or died), and
+        any process puts it back in the queue.
+
+        New smtp settings from a config reload (see ConfigPlugin) apply to
+        the next message; a worker holding a session hangs up first.
+        """
+        plugins.SimplePlugin.__init__(self, bus)
+        self.smtp = smtp
+        self.rate = smtp.get("rate")
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.test = test
+        self.poll = 5   #Seconds between checks for retries that are due
+        self.holder = "%s:%d:%s"%(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.recovered = 0     #When recover() last ran
+
+        self.wakeup = threading.Event()
+        self.threads = []
+        self.running = False
+
+    def start(self):
+        self.bus.log('Starting up mail queue')
+        self.recover()
+        self.running = True
+        self.bus.subscribe("mail-queued", self.wakeup.set)
+        self.bus.subscribe("config-changed", self.configChanged)
+        for i in range(self.workers):
+            t = threading.Thread(target=self.work, name="MailQueue-%d"%i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+    #Needs the DB plugin (50), and must be listening before the HTTP
+    #server (75) lets a request queue mail
+    start.priority = 70
+
+    def stop(self):
+        self.bus.log('Stopping down mail queue')
+        self.bus.unsubscribe("mail-queued", self.wakeup.set)
+        self.bus.unsubscribe("config-changed", self.configChanged)
+        self.running = False
+        self.wakeup.set()
+        for t in self.threads:
+            t.join(30)
+        self.threads = []
+
+    def configChanged(self, settings, changed):
+        if "smtp" in changed:
+            smtp = settings["smtp"]
+            self.rate = smtp.get("rate")
+            self.retries = smtp.get("retries", self.retries)
+            self.backoff = smtp.get("backoff", self.backoff)
+            self.smtp = smtp
+
+    def connect(self, smtp):
+        return LunchMail(smtp["server"], smtp["port"], smtp["user"], smtp["pass"],
+                         smtp.get("per_connection", 50),
+                         starttls=smtp.get("starttls", True), login=smtp.get("login", True))
+
+    def recover(self):
+        """
+        Messages claimed more than `timeout` seconds ago and still in the
+        'sending' state were interrupted by a shutdown or a crash; put them
+        back in the queue. Messages other processes are sending are left alone.
+        """
+        self.recovered = time.time()
+        expired = datetime.now() - timedelta(seconds=self.timeout)
+        db = self.bus.publish("bind-session")[0]
+        db.query(Outbox).filter(Outbox.status=="sending", or_(Outbox.claimed==None, Outbox.claimed<expired)).update(
+            {"status":"queued", "holder":None}, synchronize_session=False)
+        self.bus.publish("commit-session")
+
+    def claim(self, db):
+        """
+        Marks the oldest message that is due as 'sending' and returns it,
+        or returns None if there is nothing to send.
+        """
+        while True:
+            row = db.query(Outbox.id).filter(Outbox.status=="queued", Outbox.next_try<=datetime.now()).order_by(Outbox.id).first()
+            if row is None:
+                return None
+            claimed = db.query(Outbox).filter(Outbox.id==row.id, Outbox.status=="queued").update(
+                {"status":"sending", "attempts":Outbox.attempts+1, "holder":self.holder, "claimed":datetime.now()},
+                synchronize_session=False)
+            db.commit()
+            if claimed:
+                return db.query(Outbox).get(row.id)
+
+    def reserve(self, db):
+        """
+        Takes the next send slot, 1/rate seconds after the last one taken by
+        any process, and returns the seconds to wait for it (0 with no rate).
+        The "mail-rate" lease's expires is the time the next slot is free.
+        """
+        if not self.rate:
+            return 0
+        interval = timedelta(seconds=1.0/self.rate)
+        while True:
+            now = datetime.now()
+            slot = db.query(Lease).get("mail-rate")
+            if slot is None:
+                try:
+                    db.add(Lease(name="mail-rate", holder=self.holder, expires=now + interval))
+                    db.commit()
+                    return 0
+                except IntegrityError:
+                    #Another process created it first
+                    db.rollback()
+                    continue
+            start = max(now, slot.expires)
+            taken = db.query(Lease).filter(Lease.name=="mail-rate", Lease.expires==slot.expires).update(
+                {"holder":self.holder, "expires":start + interval}, synchronize_session=False)
+            db.commit()
+            if taken:
+                return (start - now).total_seconds()
+
+    def deliver(self, db, mail, msg):
+        """
+        Sends a claimed message and records the outcome.
+        """
+        toaddr = msg.toaddr.split(",")
+        started = time.time()
+        delivered = None
+        try:
+            if self.test:
+                send = mail.sendhtml if msg.html else mail.sendtext
+                send(toaddr, msg.subject, msg.body, test=True)
+            else:
+                mail.deliver(mail.user, toaddr, mail.message(toaddr, msg.subject, msg.body, msg.html))
+            msg.status = "sent"
+            msg.sent = datetime.now()
+            msg.error = None
+            delivered = (msg.sent - msg.created).total_seconds()
+        except Exception, e:
+            msg.error = str(e)
+            if msg.attempts >= self.retries:
+                msg.status = "failed"
+                self.bus.log("Giving up on mail %d to %s: %s"%(msg.id, msg.toaddr, e))
+            else:
+                msg.status = "queued"
+                msg.next_try = datetime.now() + timedelta(seconds=self.backoff * 2**(msg.attempts-1))
+        status = msg.status
+        db.commit()
+
+        #Seen at /metrics (see MetricsPlugin): the time to send, and from queueing to delivery
+        self.bus.publish("observe", "lunch_mail_send_seconds", time.time() - started, {"status": status})
+        if delivered is not None:
+            self.bus.publish("observe", "lunch_mail_delivery_seconds", delivered)
+
+    def work(self):
+        smtp = self.smtp
+        mail = self.connect(smtp)
+        while self.running:
+            if smtp is not self.smtp:
+                #The smtp settings were reloaded: hang up and use the new ones
+                mail.close()
+                smtp = self.smtp
+                mail = self.connect(smtp)
+            msg = None
+            db = self.bus.publish("bind-session")[0]
+            try:
+                msg = self.claim(db)
+                if msg is not None:
+                    time.sleep(self.reserve(db))
+                    self.deliver(db, mail, msg)
+                self.bus.publish("commit-session")
+            except Exception:
+                self.bus.log("Mail queue error", traceback=True)
+                msg = None
+                db.rollback()
+                db.remove()
+
+            if msg is None:
+                #Queue is empty: hang up and wait for more
+                mail.close()
+                if time.time() - self.recovered > self.timeout:
+                    try:
+                        self.recover()
+                    except Exception:
+                        self.bus.log("Mail queue error", traceback=True)
+                        db.rollback()
+                        db.remove()
+                self.wakeup.wait(self.poll)
+                self.wakeup.clear()
+        mail.close()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from cherrypy.process import plugins
+from sqlalchemy import event
+
+__all__ = ['MetricsPlugin']
+
+#Histogram bucket bounds, by the unit at the end of the metric name
+BUCKETS = {
+    "seconds": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+    "queries": (1, 2, 5, 10, 20, 50, 100, 200, 500),
+}
+
+class Histogram(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0]*len(bounds)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+class Scope(object):
+    #The queries run by one request (or Manager tick) so far
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.queries = 0
+        self.sql = 0.0
+        self.statements = {}    #statement: times run (debug only)
+
+def labelled(name, labels):
+    if not labels:
+        return name
+    return "%s{%s}"%(name, ",".join('%s="%s"'%(K, str(V).replace('\\', '\\\\').replace('"', '\\"'))
+                                     for K, V in sorted(labels.items())))
+
+class MetricsPlugin(plugins.SimplePlugin):
+    def __init__(self, bus, engine, debug=False, repeats=5):
+        """
+        This plugin keeps the process's performance counters and renders them
+        as Prometheus text for the /metrics page.
+
+        It listens to the SQLAlchemy engine's cursor events to count every
+        query and its time. A thread marks what it's doing with
+        'start-scope' (see MetricsTool for requests, and Manager.work), and
+        'end-scope' records the scope's duration, query count and SQL time as
+        <metric>_seconds, <metric>_queries and <metric>_sql_seconds
+        histograms. Anything else is timed with 'observe'.
+
+        With debug on, a scope that runs the same statement `repeats` times
+        or more is logged as a likely N+1 query loop.
+        """
+        plugins.SimplePlugin.__init__(self, bus)
+        self.engine = engine
+        self.debug = debug
+        self.repeats = repeats
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters = {}      #(name, labels): value
+        self.histograms = {}    #(name, labels): Histogram
+
+    def start(self):
+        self.bus.log('Starting up metrics')
+        event.listen(self.engine, "before_cursor_execute", self.before_execute)
+        event.listen(self.engine, "after_cursor_execute", self.after_execute)
+        self.bus.subscribe("start-scope", self.startScope)
+        self.bus.subscribe("end-scope", self.endScope)
+        self.bus.subscribe("observe", self.observe)
+        self.bus.subscribe("get-metrics", self.render)
+
+    def stop(self):
+        self.bus.log('Stopping down metrics')
+        event.remove(self.engine, "before_cursor_execute", self.before_execute)
+        event.remove(self.engine, "after_cursor_execute", self.after_execute)
+        self.bus.unsubscribe("start-scope", self.startScope)
+        self.bus.unsubscribe("end-scope", self.endScope)
+        self.bus.unsubscribe("observe", self.observe)
+        self.bus.unsubscribe("get-metrics", self.render)
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.time())
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.time() - conn.info["query_start"].pop()
+        scope = getattr(self.local, "scope", None)
+        if scope is not None:
+            scope.queries += 1
+            scope.sql += elapsed
+            if self.debug:
+                scope.statements[statement] = scope.statements.get(statement, 0) + 1
+        labels = {"scope": scope.name if scope is not None else "background"}
+        self.count("lunch_sql_queries_total", 1, labels)
+        self.count("lunch_sql_seconds_total", elapsed, labels)
+
+    def startScope(self, name):
+        '''Starts counting this thread's queries, as `name` in lunch_sql_*'''
+        self.local.scope = Scope(name)
+
+    def endScope(self, metric, labels=None):
+        '''Records the thread's current scope as <metric>_seconds, <metric>_queries and <metric>_sql_seconds'''
+        scope = getattr(self.local, "scope", None)
+        if scope is None:
+            return
+        self.local.scope = None
+        self.observe(metric + "_seconds", time.time() - scope.started, labels)
+        self.observe(metric + "_queries", scope.queries, labels)
+        self.observe(metric + "_sql_seconds", scope.sql, labels)
+        for statement, n in scope.statements.items():
+            if n >= self.repeats:
+                self.bus.log("Possible N+1 query in %s: %d x %s"%(labelled(metric, labels), n, " ".join(statement.split())))
+
+    def count(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        '''Adds a value to a histogram; its buckets depend on the name's unit (_seconds or _queries)'''
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(BUCKETS[name.rsplit("_", 1)[-1]])
+            histogram.observe(value)
+
+    def render(self):
+        '''Returns the metrics in the Prometheus text format'''
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (H.bounds, list(H.counts), H.count, H.sum)) for key, H in self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append("# TYPE %s counter"%name)
+                typed.add(name)
+            lines.append("%s %s"%(labelled(name, dict(labels)), repr(float(value))))
+        for (name, labels), (bounds, counts, count, total) in histograms:
+            if name not in typed:
+                lines.append("# TYPE %s histogram"%name)
+                typed.add(name)
+            for bound, n in zip(bounds, counts):
+                lines.append("%s %d"%(labelled(name + "_bucket", dict(labels, le=repr(float(bound)))), n))
+            lines.append("%s %d"%(labelled(name + "_bucket", dict(labels, le="+Inf")), count))
+            lines.append("%s %s"%(labelled(name + "_sum", dict(labels)), repr(float(total))))
+            lines.append("%s %d"%(labelled(name + "_count", dict(labels)), count))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import cherrypy
+
+__all__ = ['MetricsTool', 'handlerName']
+
+def handlerName():
+    '''
+    The page the current request hit: "/" or an exposed handler such as
+    "/vote", "/static" for static files and "other" for anything else.
+    '''
+    request = cherrypy.serving.request
+    name = request.path_info.strip('/').split('/')[0]
+    root = request.app.root if request.app is not None else None
+    if name in ('', 'static') or getattr(getattr(root, name, None), 'exposed', False):
+        return '/' + name
+    return 'other'
+
+class MetricsTool(cherrypy.Tool):
+    def __init__(self):
+        """
+        The metrics tool times each request and counts its queries, by
+        asking the metrics plugin (see MetricsPlugin) to start a scope when
+        the request starts and to record it once the response has been
+        written, so a streamed page is timed until its last chunk.
+
+        Requests are labelled with the page they hit (see handlerName), which
+        keeps the number of labels fixed.
+        """
+        cherrypy.Tool.__init__(self, 'on_start_resource',
+                               self.start_request,
+                               priority=10)
+
+    def _setup(self):
+        cherrypy.Tool._setup(self)
+        cherrypy.request.hooks.attach('on_end_request',
+                                      self.end_request)
+
+    def start_request(self):
+        cherrypy.engine.publish('start-scope', 'request')
+
+    def end_request(self):
+        cherrypy.engine.publish('end-scope', 'lunch_request', {'handler': handlerName()})
+
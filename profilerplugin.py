@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+import os, os.path
+import sys
+import gc
+import threading
+import time
+import tempfile
+import cProfile
+import pstats
+from datetime import datetime
+from StringIO import StringIO
+import cherrypy
+from cherrypy import _cprequest
+from cherrypy.process import plugins
+from metricstool import handlerName
+
+__all__ = ['ProfilerPlugin', 'Report']
+
+class Report(object):
+    '''
+    A finished (or still running) profile. Depending on its kind it holds a
+    pstats.Stats ("profile"), collapsed stack counts ("sample") or object
+    counts by type ("memory").
+    '''
+    def __init__(self, id, kind, title):
+        self.id = id
+        self.kind = kind
+        self.title = title
+        self.created = datetime.now()
+        self.done = False
+        self.count = 0          #Requests profiled, or stacks sampled
+        self.running = 0        #Requests being profiled now
+        self.stats = None       #pstats.Stats, from the first profiled request
+        self.stacks = {}        #"outer;...;inner": samples
+        self.objects = {}       #type name: (objects, bytes)
+        self.summary = ""
+
+    def formats(self):
+        if self.kind == "profile" and self.stats is None:
+            return ["text"]
+        return {"profile": ["text", "pstats"],
+                "sample": ["text", "collapsed"],
+                "memory": ["text", "counts"]}[self.kind]
+
+    def text(self):
+        '''A readable summary: the top functions, stacks or allocations'''
+        out = StringIO()
+        out.write("%s, %s: %d %s\n\n"%(self.title, self.created.strftime("%Y-%m-%d %H:%M:%S"), self.count,
+                                       {"profile":"requests", "sample":"samples", "memory":"objects"}[self.kind]))
+        if self.kind == "profile":
+            if self.stats is not None:
+                self.stats.stream = out
+                self.stats.sort_stats("cumulative").print_stats(50)
+        elif self.kind == "sample":
+            for stack, n in sorted(self.stacks.items(), key=lambda S: -S[1])[:50]:
+                out.write("%6d  %s\n"%(n, stack.split(";")[-1]))
+                out.write("        %s\n"%(" < ".join(reversed(stack.split(";")[:-1]))))
+        else:
+            out.write(self.summary)
+        return out.getvalue()
+
+    def pstats(self):
+        '''The profile as a pstats file, for pstats.Stats(file) or snakeviz'''
+        fd, filename = tempfile.mkstemp(suffix=".pstats")
+        os.close(fd)
+        try:
+            self.stats.dump_stats(filename)
+            with open(filename, "rb") as F:
+                return F.read()
+        finally:
+            os.remove(filename)
+
+    def collapsed(self):
+        '''The samples as collapsed stacks, the input of flamegraph.pl and speedscope'''
+        return "".join("%s %d\n"%(stack, n) for stack, n in sorted(self.stacks.items()))
+
+    def counts(self):
+        '''The object counts as tab-separated type, objects and bytes, for a spreadsheet'''
+        return "".join("%s\t%d\t%d\n"%(name, n, size) for name, (n, size) in
+                       sorted(self.objects.items(), key=lambda O: -O[1][1]))
+
+def frameName(frame):
+    code = frame.f_code
+    return "%s:%s"%(os.path.basename(code.co_filename), code.co_name)
+
+class ProfilerPlugin(plugins.SimplePlugin):
+    def __init__(self, bus, keep=20):
+        """
+        This plugin profiles the live server on demand, for the /profile
+        page. Nothing here runs until it is asked for.
+
+        'profile-requests' profiles the next N requests to one handler
+        (named as in the request metrics, e.g. "/results") with cProfile.
+        Its hooks are added to every request only until N have started.
+
+        'sample-thread' samples a thread's stack (e.g. the Manager's) every
+        few milliseconds for a while, from a thread of its own, and counts
+        the stacks for a flame graph.
+
+        'count-objects' counts the objects the garbage collector tracks by
+        type, with their sizes, and compares them to the last count, to find
+        what is growing.
+
+        The last `keep` reports are kept in memory; 'get-reports' lists
+        them and 'get-report' returns one by id.
+        """
+        plugins.SimplePlugin.__init__(self, bus)
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.reports = []
+        self.ids = 0
+        self.target = None          #Handler being profiled
+        self.remaining = 0          #Requests still to profile
+        self.profiling = None       #Report for the requests being profiled
+        self.sampler = None
+        self.sampled = None         #Report for the thread being sampled
+        self.sampling = threading.Event()
+        self.previous = None        #Last object counts, to compare to
+
+    def start(self):
+        self.bus.log('Starting up profiler')
+        self.bus.subscribe("profile-requests", self.profileRequests)
+        self.bus.subscribe("sample-thread", self.sampleThread)
+        self.bus.subscribe("count-objects", self.countObjects)
+        self.bus.subscribe("get-reports", self.getReports)
+        self.bus.subscribe("get-report", self.getReport)
+        self.bus.subscribe("get-profiling", self.status)
+
+    def stop(self):
+        self.bus.log('Stopping down profiler')
+        self.bus.unsubscribe("profile-requests", self.profileRequests)
+        self.bus.unsubscribe("sample-thread", self.sampleThread)
+        self.bus.unsubscribe("count-objects", self.countObjects)
+        self.bus.unsubscribe("get-reports", self.getReports)
+        self.bus.unsubscribe("get-report", self.getReport)
+        self.bus.unsubscribe("get-profiling", self.status)
+        with self.lock:
+            self.remaining = 0
+            self.detach()
+        self.sampling.clear()
+        if self.sampler is not None:
+            self.sampler.join(5)
+            self.sampler = None
+
+    def add(self, kind, title):
+        #Call with the lock held
+        self.ids += 1
+        report = Report(self.ids, kind, title)
+        self.reports.append(report)
+        del self.reports[:-self.keep]
+        return report
+
+    def getReports(self):
+        '''The kept reports, newest first'''
+        with self.lock:
+            return list(reversed(self.reports))
+
+    def getReport(self, id):
+        with self.lock:
+            for report in self.reports:
+                if report.id == id:
+                    return report
+        return None
+
+    def status(self):
+        '''
+        What's running: (handler or None, requests left, sampling report or None)
+        '''
+        with self.lock:
+            return (self.target if self.remaining else None, self.remaining,
+                    self.sampled if self.sampling.is_set() else None)
+
+    ### cProfile, request by request
+
+    def profileRequests(self, handler, count):
+        '''Profiles the next `count` requests to `handler`; returns the report'''
+        with self.lock:
+            self.profiling = self.add("profile", "%d requests to %s"%(count, handler))
+            self.target = handler
+            self.remaining = count
+            self.attach()
+            return self.profiling
+
+    def attach(self):
+        #Added to the class's hooks, which each new request copies
+        hooks = _cprequest.Request.hooks
+        self.detach()
+        hooks['on_start_resource'] = hooks['on_start_resource'] + [_cprequest.Hook(self.startRequest, priority=1)]
+        hooks['on_end_request'] = hooks['on_end_request'] + [_cprequest.Hook(self.endRequest, True, 99)]
+
+    def detach(self):
+        hooks = _cprequest.Request.hooks
+        for point, callback in (('on_start_resource', self.startRequest), ('on_end_request', self.endRequest)):
+            hooks[point] = [H for H in hooks[point] if H.callback != callback]
+
+    def startRequest(self):
+        if handlerName() != self.target:
+            return
+        with self.lock:
+            if self.remaining <= 0:
+                return
+            self.remaining -= 1
+            if self.remaining == 0:
+                #Requests already running keep their copy of the hooks
+                self.detach()
+            report = self.profiling
+            report.running += 1
+        profile = cProfile.Profile()
+        cherrypy.serving.request.profile = (report, profile)
+        profile.enable()
+
+    def endRequest(self):
+        #Runs after the body has been written, so a streamed page is profiled to the end
+        request = cherrypy.serving.request
+        profiling = getattr(request, 'profile', None)
+        if profiling is None:
+            return
+        report, profile = profiling
+        profile.disable()
+        request.profile = None
+        with self.lock:
+            if report.stats is None:
+                report.stats = pstats.Stats(profile)
+            else:
+                report.stats.add(profile)
+            report.count += 1
+            report.running -= 1
+            report.done = report.running == 0 and (report is not self.profiling or self.remaining == 0)
+
+    ### Stack sampling, from a thread of its own
+
+    def sampleThread(self, name, seconds, interval=0.005):
+        '''Samples the stack of the thread called `name` for `seconds`; returns the report, or None if there's no such thread'''
+        with self.lock:
+            if self.sampling.is_set():
+                return None
+            target = dict((T.name, T) for T in threading.enumerate()).get(name)
+            if target is None:
+                return None
+            report = self.sampled = self.add("sample", "%ds of thread %s"%(seconds, name))
+            self.sampling.set()
+            self.sampler = threading.Thread(target=self.sample, name="Profiler",
+                                            args=(report, target.ident, time.time() + seconds, interval))
+            self.sampler.daemon = True
+            self.sampler.start()
+            return report
+
+    def sample(self, report, ident, until, interval):
+        try:
+            while self.sampling.is_set() and time.time() < until:
+                frame = sys._current_frames().get(ident)
+                if frame is None:
+                    #The thread has finished
+                    break
+                stack = []
+                while frame is not None:
+                    stack.append(frameName(frame))
+                    frame = frame.f_back
+                del frame
+                key = ";".join(reversed(stack))
+                with self.lock:
+                    report.stacks[key] = report.stacks.get(key, 0) + 1
+                    report.count += 1
+                time.sleep(interval)
+        finally:
+            report.done = True
+            self.sampling.clear()
+
+    ### Object counts
+
+    def countObjects(self):
+        '''
+        Counts the objects the garbage collector tracks (containers and
+        class instances, not strings or numbers) by type, with their shallow
+        sizes, compared to the last count; returns the report.
+        '''
+        objects = {}
+        for obj in gc.get_objects():
+            name = type(obj).__name__
+            n, size = objects.get(name, (0, 0))
+            objects[name] = (n + 1, size + sys.getsizeof(obj, 0))
+
+        top = sorted(objects.items(), key=lambda O: -O[1][1])
+        lines = ["Tracked: %d objects, %.1f KiB\n\nTop types:\n"%(sum(n for n, size in objects.values()),
+                 sum(size for n, size in objects.values())/1024.0)]
+        lines.extend("%10d %10.1f KiB  %s\n"%(n, size/1024.0, name) for name, (n, size) in top[:30])
+        if self.previous is not None:
+            changes = [(name, n - self.previous.get(name, (0, 0))[0], size - self.previous.get(name, (0, 0))[1])
+                       for name, (n, size) in objects.items()]
+            changes.extend((name, -n, -size) for name, (n, size) in self.previous.items() if name not in objects)
+            lines.append("\nChanges since the last count:\n")
+            lines.extend("%+10d %+10.1f KiB  %s\n"%(n, size/1024.0, name)
+                         for name, n, size in sorted(changes, key=lambda C: -abs(C[2]))[:30] if n or size)
+        self.previous = objects
+        with self.lock:
+            report = self.add("memory", "Object counts")
+        report.objects = objects
+        report.summary = "".join(lines)
+        report.count = sum(n for n, size in objects.values())
+        report.done = True
+        return report
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+import socket
+from cherrypy._cpwsgi_server import CPWSGIServer
+
+__all__ = ['ReusePortServer']
+
+class ReusePortServer(CPWSGIServer):
+    """
+    CherryPy's HTTP server with SO_REUSEPORT set on its listening socket,
+    so several lunch.py processes can listen on the same port and the
+    kernel spreads new connections between them (Linux 3.9+ and the BSDs).
+
+    Select it with 'server.instance': 'reuseport.ReusePortServer'.
+    """
+    @staticmethod
+    def bind_socket(socket_, bind_addr):
+        socket_.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return CPWSGIServer.bind_socket(socket_, bind_addr)
@@ -3,11 +3,12 @@ import cherrypy
 from cherrypy.process import wspbus, plugins
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
+from LunchDB import reprofile
 
 __all__ = ['SAEnginePlugin']
         
 class SAEnginePlugin(plugins.SimplePlugin):
-    def __init__(self, bus, connection_string=None):
+    def __init__(self, bus, connection_string=None, engine=None):
         """
         The plugin is registered to the CherryPy engine and therefore
         is part of the bus (the engine *is* a bus) registery.
@@ -15,27 +16,43 @@ class SAEnginePlugin(plugins.SimplePlugin):
         We use this plugin to create the SA engine. At the same time,
         when the plugin starts we create the tables into the database
         using the mapped class of the global metadata.
+
+        Pass an existing engine (see LunchDB.createEngine) to share it
+        rather than creating a second one from the connection string. Its
+        sqlite pragmas follow the "database" settings when the config is
+        reloaded (see ConfigPlugin).
         """
         plugins.SimplePlugin.__init__(self, bus)
         self.sa_engine = None
+        self.engine = engine
         self.connection_string = connection_string
         self.session = scoped_session(sessionmaker(autoflush=True,
                                                    autocommit=False))
  
     def start(self):
         self.bus.log('Starting up DB access')
-        self.sa_engine = create_engine(self.connection_string, echo=False)
+        if self.engine is not None:
+            self.sa_engine = self.engine
+        else:
+            self.sa_engine = create_engine(self.connection_string, echo=False)
         self.bus.subscribe("bind-session", self.bind)
         self.bus.subscribe("commit-session", self.commit)
+        self.bus.subscribe("config-changed", self.configChanged)
  
     def stop(self):
         self.bus.log('Stopping down DB access')
         self.bus.unsubscribe("bind-session", self.bind)
         self.bus.unsubscribe("commit-session", self.commit)
+        self.bus.unsubscribe("config-changed", self.configChanged)
         if self.sa_engine:
             self.sa_engine.dispose()
             self.sa_engine = None
  
+    def configChanged(self, settings, changed):
+        if "database" in changed and hasattr(self.sa_engine, "sqlite_profile"):
+            reprofile(self.sa_engine, settings["database"])
+            self.bus.log('Applied the new database settings')
+
     def bind(self):
         """
         Whenever this plugin receives the 'bind-session' command, it applies
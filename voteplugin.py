@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+import threading
+import Queue
+from datetime import datetime
+from cherrypy.process import plugins
+
+from LunchDB import Vote, Restaurant, EventWindow
+from LunchRank import applyVotes
+
+__all__ = ['VoteWriterPlugin']
+
+class VoteTicket(object):
+    """
+    A ballot waiting for the writer. The submitting request blocks on
+    wait() until the ballot is committed (or has failed).
+    """
+    def __init__(self, eventid, userid, ranks):
+        self.eventid = eventid
+        self.userid = userid
+        self.ranks = ranks      #{restaurant id: rank}
+        self.done = threading.Event()
+        self.updated = False    #True if this replaced an earlier ballot, None if voting had closed
+        self.error = None
+
+    def finish(self, error=None):
+        self.error = error
+        self.done.set()
+
+    def wait(self, timeout):
+        if not self.done.wait(timeout):
+            raise RuntimeError("Timed out waiting for the vote writer")
+        if self.error is not None:
+            raise self.error
+        return self.updated
+
+class VoteWriterPlugin(plugins.SimplePlugin):
+    def __init__(self, bus, batch=100, timeout=30):
+        """
+        This plugin funnels every vote submission through one writer thread.
+        Ballots that arrive while a transaction is being written are queued
+        and then written together: one bulk delete of the voters' old votes,
+        one insert of the new ones, one rating histogram update and a single
+        commit for up to `batch` ballots. SQLite only allows one writer at a
+        time anyway, so this replaces a lock queue of small transactions with
+        a few large ones.
+
+        Requests publish 'submit-vote' and block until their ballot is
+        committed; it returns True if the ballot replaced an earlier one, or
+        None if voting closed first. Each batch also advances the events'
+        EventWindow.ballots count, which lets every process tell whether its
+        live tally has all the ballots (see OpenEvent in lunch.py).
+        """
+        plugins.SimplePlugin.__init__(self, bus)
+        self.batch = batch
+        self.timeout = timeout
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.bus.log('Starting up vote writer')
+        self.running = True
+        self.bus.subscribe("submit-vote", self.submit)
+        self.thread = threading.Thread(target=self.work, name="VoteWriter")
+        self.thread.daemon = True
+        self.thread.start()
+    #After the DB plugin (50), and ahead of the HTTP server (75) so ballots
+    #always have a writer
+    start.priority = 70
+
+    def stop(self):
+        self.bus.log('Stopping down vote writer')
+        self.bus.unsubscribe("submit-vote", self.submit)
+        self.running = False
+        self.queue.put(None)
+        if self.thread is not None:
+            self.thread.join(30)
+            self.thread = None
+
+    def submit(self, eventid, userid, ranks):
+        """
+        Queues a {restaurant id: rank} ballot and waits until it's written.
+        """
+        ticket = VoteTicket(eventid, userid, ranks)
+        self.queue.put(ticket)
+        return ticket.wait(self.timeout)
+
+    def take(self):
+        #Blocks for the first ticket, then takes whatever else is waiting
+        tickets = [self.queue.get()]
+        while len(tickets) < self.batch:
+            try:
+                tickets.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return [T for T in tickets if T is not None]
+
+    def write(self, db, tickets):
+        """
+        Writes a batch of ballots in one transaction. If a voter appears
+        more than once, their last ballot wins. Returns the ballots written
+        and a list of (event id, ballots before, ballots after) counts.
+        """
+        #Ballots can only be cast until the event's window closes, whichever process closes it
+        events = set(T.eventid for T in tickets)
+        isopen = set(R[0] for R in db.query(EventWindow.event).filter(EventWindow.event.in_(events),
+                   EventWindow.closed==False, EventWindow.closes>datetime.now()).all())
+        for ticket in tickets:
+            if ticket.eventid not in isopen:
+                ticket.updated = None
+                ticket.finish()
+        tickets = [T for T in tickets if T.eventid in isopen]
+
+        latest = {}
+        for ticket in tickets:
+            ticket.updated = False
+            key = (ticket.eventid, ticket.userid)
+            if key in latest:
+                ticket.updated = True
+            latest[key] = ticket
+
+        byevent = {}
+        for (eventid, userid) in latest:
+            byevent.setdefault(eventid, []).append(userid)
+
+        voted = set()
+        for eventid, users in byevent.items():
+            oldvotes = db.query(Vote.user, Vote.restaurant, Vote.rank).filter(Vote.event==eventid, Vote.user.in_(users)).all()
+            if oldvotes:
+                voted.update((eventid, V.user) for V in oldvotes)
+                db.query(Vote).filter(Vote.event==eventid, Vote.user.in_(users)).delete(synchronize_session=False)
+                applyVotes(db, oldvotes, -1)
+
+        newvotes = [Vote(event=T.eventid, user=T.userid, restaurant=rest, rank=rank)
+                    for T in latest.values() for rest, rank in T.ranks.items()]
+        db.bulk_save_objects(newvotes)
+        applyVotes(db, newvotes)
+
+        counts = {}
+        for eventid, userid in latest:
+            counts[eventid] = counts.get(eventid, 0) + 1
+        synced = []
+        for eventid, n in counts.items():
+            db.query(EventWindow).filter(EventWindow.event==eventid).update(
+                {"ballots":EventWindow.ballots+n}, synchronize_session=False)
+            after = db.query(EventWindow.ballots).filter(EventWindow.event==eventid).scalar()
+            synced.append((eventid, after-n, after))
+        self.bus.publish("commit-session")
+
+        for ticket in tickets:
+            ticket.updated = ticket.updated or (ticket.eventid, ticket.userid) in voted
+        return latest.values(), synced
+
+    def tally(self, db, written, synced):
+        #Hands the committed ballots to the live tally (see OpenEvent in lunch.py)
+        rests = set(rest for T in written for rest in T.ranks)
+        names = dict(db.query(Restaurant.id, Restaurant.name).filter(Restaurant.id.in_(rests)).all())
+        self.bus.publish("commit-session")
+        for T in written:
+            self.bus.publish("tally-vote", T.eventid, T.userid,
+                             dict((names[rest], rank) for rest, rank in T.ranks.items()))
+        for eventid, before, after in synced:
+            self.bus.publish("tally-synced", eventid, before, after)
+
+    def work(self):
+        while self.running or not self.queue.empty():
+            tickets = self.take()
+            if not tickets:
+                continue
+
+            #Write the batch; if it fails, write the ballots one at a time
+            #so a single bad ballot doesn't fail everyone else's
+            batches = [tickets]
+            written = []
+            synced = []
+            while batches:
+                batch = batches.pop(0)
+                db = self.bus.publish("bind-session")[0]
+                try:
+                    ballots, counts = self.write(db, batch)
+                    written.extend(ballots)
+                    synced.extend(counts)
+                except Exception, e:
+                    db.rollback()
+                    db.remove()
+                    if len(batch) > 1:
+                        batches.extend([T] for T in batch)
+                    else:
+                        self.bus.log("Vote writer error", traceback=True)
+                        batch[0].finish(e)
+
+            if written:
+                self.bus.publish("invalidate-leaderboard")
+                try:
+                    self.tally(self.bus.publish("bind-session")[0], written, synced)
+                except Exception:
+                    #The votes are committed; the tally is rebuilt from them when next needed
+                    self.bus.log("Vote writer tally error", traceback=True)
+                    self.bus.publish("reset-tally")
+            for ticket in tickets:
+                if not ticket.done.is_set():
+                    ticket.finish()